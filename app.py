@@ -1,4 +1,6 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
 import snowflake.connector
 
@@ -7,7 +9,7 @@ try:
     for key in (
         "SNOWFLAKE_ACCOUNT", "SNOWFLAKE_USER", "SNOWFLAKE_PASSWORD",
         "SNOWFLAKE_DATABASE", "SNOWFLAKE_SCHEMA", "SNOWFLAKE_WAREHOUSE",
-        "OPENAI_API_KEY",
+        "OPENAI_API_KEY", "CACHE_DB_PATH", "SCHEMA_TOP_K",
     ):
         val = st.secrets.get(key)
         if val is not None:
@@ -15,9 +17,11 @@ try:
 except Exception:
     pass  # No st.secrets available (local dev) — core.py will use .env / env vars
 
-# --- Import shared logic from core ---
-from core import (  # noqa: E402
+# --- Import shared logic from core (some names only re-exported for tests) ---
+from core import (  # noqa: E402, F401
     get_secret,
+    MAX_CHAT_ROUNDS,
+    MAX_QUERY_WORKERS,
     SF_CONFIG,
     OPENAI_API_KEY,
     DB,
@@ -27,24 +31,19 @@ from core import (  # noqa: E402
     SCHEMA_CONTEXT,
     SYSTEM_PROMPT,
     _strip_sql_comments,
+    compact_history,
     is_safe_sql,
     is_off_topic,
     extract_sql,
-    get_openai_client,
+    results_turn,
+    rows_to_csv,
+    chat_with_llm,
+    stream_chat_with_llm,
+    tee_sql_blocks,
     run_query as _core_run_query,
 )
 
 
-def chat_with_llm(messages):
-    """Send messages to OpenAI using the Responses API."""
-    client = get_openai_client()
-    response = client.responses.create(
-        model="gpt-5.2",
-        instructions=SYSTEM_PROMPT,
-        input=messages,
-    )
-    return response.output_text
-
 # --- Snowflake connection ---
 @st.cache_resource
 def get_snowflake_connection():
@@ -52,7 +51,10 @@ def get_snowflake_connection():
 
 
 def run_query(sql, max_rows=500):
-    """Execute a read-only SQL query and return results as list of dicts."""
+    """Execute a read-only SQL query and return results as list of dicts.
+
+    Reruns are served from core's query cache, which both frontends share.
+    """
     conn = get_snowflake_connection()
     return _core_run_query(sql, conn, max_rows=max_rows)
 
@@ -62,9 +64,12 @@ st.set_page_config(page_title="Census Chat", page_icon="📊", layout="centered"
 st.title("📊 Census Chat")
 st.caption("Ask questions about US population data (2019 American Community Survey)")
 
-# Session state
+# Session state — `messages` is what we display, `llm_messages` is the full
+# transcript (including query results) we send to the LLM
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "llm_messages" not in st.session_state:
+    st.session_state.llm_messages = []
 
 # Display chat history
 for msg in st.session_state.messages:
@@ -84,57 +89,73 @@ if prompt := st.chat_input("Ask a question about US census data..."):
     with st.chat_message("user"):
         st.markdown(prompt)
 
-    # Build message history for LLM
-    llm_messages = [{"role": m["role"], "content": m["content"]} for m in st.session_state.messages]
-
-    # Multi-turn: LLM may generate SQL, we execute it, feed results back
-    max_rounds = 5
-    for _ in range(max_rounds):
-        with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                response_text = chat_with_llm(llm_messages)
-
-            # Check for SQL in response
-            sql_queries = extract_sql(response_text)
-
-            if not sql_queries:
-                # No SQL — just a text response, we're done
-                st.markdown(response_text)
+    # Append-only LLM history within a turn, so each round's input extends the
+    # previous one and OpenAI's prompt prefix cache keeps hitting. Finished
+    # turns are compacted first to keep the input size bounded.
+    llm_messages = st.session_state.llm_messages
+    compact_history(llm_messages)
+    llm_messages.append({"role": "user", "content": prompt})
+
+    with ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS) as pool:
+        # Open the Snowflake connection (a no-op once it's cached) while the
+        # model writes its first response
+        pool.submit(get_snowflake_connection)
+
+        # Multi-turn: LLM may generate SQL, we execute it, feed results back
+        for _ in range(MAX_CHAT_ROUNDS):
+            with st.chat_message("assistant"):
+                # Stream the response, starting each safe query as soon as its
+                # ```sql block closes instead of waiting for the model to finish
+                prefetched = {}
+
+                def prefetch(sql):
+                    if sql not in prefetched and is_safe_sql(sql):
+                        prefetched[sql] = pool.submit(run_query, sql)
+
+                response_text = st.write_stream(
+                    tee_sql_blocks(stream_chat_with_llm(llm_messages), prefetch)
+                )
+
+                # Check for SQL in response
+                sql_queries = extract_sql(response_text)
+
+                if not sql_queries:
+                    # No SQL — just a text response, we're done
+                    st.session_state.messages.append({"role": "assistant", "content": response_text})
+                    llm_messages.append({"role": "assistant", "content": response_text})
+                    break
+
+                # There's SQL to execute
                 st.session_state.messages.append({"role": "assistant", "content": response_text})
-                break
-
-            # There's SQL to execute
-            st.markdown(response_text)
-            st.session_state.messages.append({"role": "assistant", "content": response_text})
-
-            # Execute each SQL query
-            all_results = []
-            for sql in sql_queries:
-                if not is_safe_sql(sql):
-                    error_msg = "⚠️ That query was blocked for safety reasons. I can only run SELECT queries."
-                    st.warning(error_msg)
-                    all_results.append(error_msg)
-                    continue
-
-                with st.spinner("Querying Snowflake..."):
-                    result = run_query(sql)
-
-                if isinstance(result, dict) and "error" in result:
-                    error_msg = f"Query error: {result['error']}"
-                    st.error(error_msg)
-                    all_results.append(error_msg)
-                else:
-                    st.dataframe(result, use_container_width=True)
-                    all_results.append(str(result))
-
-            # Feed results back to LLM for summarization
-            results_text = "\n\n".join(
-                f"Query result {i+1}:\n{r}" for i, r in enumerate(all_results)
-            )
-            result_message = f"Here are the query results:\n\n{results_text}\n\nPlease summarize these results in a clear, conversational way to answer the user's question. Do not output any more SQL."
-            llm_messages.append({"role": "assistant", "content": response_text})
-            llm_messages.append({"role": "user", "content": result_message})
-    else:
-        # Exhausted max rounds
-        with st.chat_message("assistant"):
-            st.markdown("I had trouble completing that query. Could you try rephrasing your question?")
+
+                # Start whatever the stream didn't already, so all queries run concurrently
+                for sql in sql_queries:
+                    prefetch(sql)
+
+                # Collect each SQL query's result in order
+                all_results = []
+                for sql in sql_queries:
+                    if not is_safe_sql(sql):
+                        error_msg = "⚠️ That query was blocked for safety reasons. I can only run SELECT queries."
+                        st.warning(error_msg)
+                        all_results.append(error_msg)
+                        continue
+
+                    with st.spinner("Querying Snowflake..."):
+                        result = prefetched[sql].result()
+
+                    if isinstance(result, dict) and "error" in result:
+                        error_msg = f"Query error: {result['error']}"
+                        st.error(error_msg)
+                        all_results.append(error_msg)
+                    else:
+                        st.dataframe(result, use_container_width=True)
+                        all_results.append(rows_to_csv(result))
+
+                # Feed results back to LLM for summarization
+                llm_messages.append({"role": "assistant", "content": response_text})
+                llm_messages.append(results_turn(all_results))
+        else:
+            # Exhausted max rounds
+            with st.chat_message("assistant"):
+                st.markdown("I had trouble completing that query. Could you try rephrasing your question?")
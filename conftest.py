@@ -0,0 +1,46 @@
+"""Shared pytest setup: fake credentials for every module under test."""
+
+import os
+
+import pytest
+
+TEST_ENV = {
+    "SNOWFLAKE_ACCOUNT": "test_account",
+    "SNOWFLAKE_USER": "test_user",
+    "SNOWFLAKE_PASSWORD": "test_password",
+    "SNOWFLAKE_DATABASE": "TEST_DB",
+    "SNOWFLAKE_SCHEMA": "TEST_SCHEMA",
+    "SNOWFLAKE_WAREHOUSE": "TEST_WH",
+    "OPENAI_API_KEY": "sk-test-key",
+    "CACHE_DB_PATH": "",  # never touch a developer's real cache.db
+    "SCHEMA_TOP_K": "",
+}
+
+_saved_env = {}
+
+
+def pytest_configure(config):
+    """Set the env once, before any test module imports core."""
+    config.addinivalue_line("markers", "slow: large payloads; deselect with -m 'not slow'")
+    _saved_env.update({key: os.environ.get(key) for key in TEST_ENV})
+    os.environ.update(TEST_ENV)
+
+
+def pytest_unconfigure(config):
+    for key, value in _saved_env.items():
+        if value is None:
+            os.environ.pop(key, None)
+        else:
+            os.environ[key] = value
+
+
+@pytest.fixture(autouse=True)
+def reset_core_state():
+    """Empty core's in-process caches so every test starts cold."""
+    import core
+
+    core._SEM_CACHE.clear()
+    core._QUERY_CACHE.clear()
+    for cached in (core.get_openai_client, core._cached_question_embedding,
+                   core._schema_fragment_vectors, core.is_safe_sql, core.is_off_topic):
+        cached.cache_clear()
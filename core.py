@@ -1,10 +1,24 @@
 """Shared pure logic for Census Chat — no framework dependencies (Streamlit/Flask)."""
 
+import collections
+import csv
+import datetime
+import decimal
+import functools
+import hashlib
+import io
+import json
 import os
 import re
+import sqlite3
+import threading
+import time
 
+import numpy as np
+import orjson
 from dotenv import load_dotenv
 from openai import OpenAI
+from snowflake.connector import DictCursor
 
 load_dotenv()
 
@@ -24,39 +38,49 @@ SF_CONFIG = {
     "warehouse": get_secret("SNOWFLAKE_WAREHOUSE"),
 }
 OPENAI_API_KEY = get_secret("OPENAI_API_KEY")
+CACHE_DB_PATH = get_secret("CACHE_DB_PATH")  # unset = caches live in memory only
+SCHEMA_TOP_K = int(get_secret("SCHEMA_TOP_K") or 0)  # unset = always send the full schema
 DB = SF_CONFIG["database"]
 SCHEMA = SF_CONFIG["schema"]
 
 
 # --- SQL safety ---
+DANGEROUS_WORDS = frozenset({
+    "DROP", "DELETE", "INSERT", "UPDATE", "ALTER", "CREATE", "TRUNCATE",
+    "REPLACE", "MERGE", "GRANT", "REVOKE", "EXEC", "EXECUTE",
+})
 DANGEROUS_KEYWORDS = re.compile(
-    r"\b(DROP|DELETE|INSERT|UPDATE|ALTER|CREATE|TRUNCATE|REPLACE|MERGE|GRANT|REVOKE|EXEC|EXECUTE)\b",
+    rf"\b({'|'.join(sorted(DANGEROUS_WORDS))})\b",
     re.IGNORECASE,
 )
 
 
+_LEADING_COMMENT_RE = re.compile(r"\s*(?:--[^\n]*(?:\n|\Z)|/\*.*?\*/)", re.DOTALL)
+
+
 def _strip_sql_comments(sql):
     """Remove leading -- line comments and /* block comments */ so we can inspect the first keyword."""
-    s = sql.strip()
-    while s.startswith("--"):
-        s = s.split("\n", 1)[-1].strip()
-    while s.startswith("/*"):
-        end = s.find("*/")
-        if end == -1:
-            break
-        s = s[end + 2 :].strip()
-    return s
+    if "--" not in sql and "/*" not in sql:
+        return sql.strip()  # the common case: no regex work at all
+    s = sql
+    while m := _LEADING_COMMENT_RE.match(s):
+        s = s[m.end() :]
+    return s.strip()
+
 
+# Keyword check as one C-level word split plus a set lookup — the same \b-bounded
+# matches as DANGEROUS_KEYWORDS, without trying 13 alternatives at every offset
+_SQL_LEAD_RE = re.compile(r"(?:SELECT|WITH)\b", re.IGNORECASE)
+_SQL_WORD_RE = re.compile(r"\w+")
 
+
+@functools.lru_cache(maxsize=1024)
 def is_safe_sql(sql):
     """Only allow SELECT / WITH ... SELECT statements."""
-    stripped = _strip_sql_comments(sql).rstrip(";").strip()
-    first_word = stripped.split()[0].upper() if stripped.split() else ""
-    if first_word not in ("SELECT", "WITH"):
-        return False
-    if DANGEROUS_KEYWORDS.search(stripped):
+    stripped = _strip_sql_comments(sql).rstrip(";")
+    if not _SQL_LEAD_RE.match(stripped):
         return False
-    return True
+    return DANGEROUS_WORDS.isdisjoint(_SQL_WORD_RE.findall(stripped.upper()))
 
 
 # --- Guardrails ---
@@ -66,16 +90,20 @@ OFF_TOPIC_PATTERNS = re.compile(
 )
 
 
+@functools.lru_cache(maxsize=1024)
 def is_off_topic(text):
     return bool(OFF_TOPIC_PATTERNS.search(text))
 
 
 # --- Schema context for the LLM ---
-SCHEMA_CONTEXT = f"""
+@functools.cache
+def build_schema_context(db, schema):
+    """Describe the Census tables for the LLM, fully qualified with db and schema."""
+    return f"""
 You have access to a Snowflake database with US Census data (American Community Survey 2019).
 
-Database: {DB}
-Schema: {SCHEMA}
+Database: {db}
+Schema: {schema}
 
 === KEY TABLES ===
 
@@ -150,12 +178,12 @@ The lowercase "e" and "m" suffixes are part of the stored name. Without double q
 - ALWAYS double-quote coded column names: "B08135e1", "B08303e1", "B07201e1", etc.
 - Column names with spaces MUST be quoted with double quotes: "30.0 to 34.9 percent: Renter-occupied housing units"
 - ALL table names start with a number and MUST be double-quoted. Fully qualify them as:
-  {DB}.{SCHEMA}."2019_CBG_B08"
-  {DB}.{SCHEMA}."2019_CBG_B07"
-  {DB}.{SCHEMA}."2019_CBG_B16"
-  {DB}.{SCHEMA}."2019_METADATA_CBG_FIPS_CODES"
-  {DB}.{SCHEMA}."2019_METADATA_CBG_FIELD_DESCRIPTIONS"
-  {DB}.{SCHEMA}."2019_RENT_PERCENTAGE_HOUSEHOLD_INCOME"
+  {db}.{schema}."2019_CBG_B08"
+  {db}.{schema}."2019_CBG_B07"
+  {db}.{schema}."2019_CBG_B16"
+  {db}.{schema}."2019_METADATA_CBG_FIPS_CODES"
+  {db}.{schema}."2019_METADATA_CBG_FIELD_DESCRIPTIONS"
+  {db}.{schema}."2019_RENT_PERCENTAGE_HOUSEHOLD_INCOME"
   Without the double quotes around the table name, Snowflake will error with 'unexpected .2019'.
 - To aggregate by state: GROUP BY LEFT(cbg.CENSUS_BLOCK_GROUP, 2), then join to FIPS codes.
 - When the user asks about "over 30% of income on rent", sum the columns for 30-34.9%, 35-39.9%, 40-49.9%, and 50%+ from the rent table.
@@ -193,9 +221,13 @@ Key B16 (Language) fields:
 - To get non-English speakers: total population minus English-only speakers = "B16004e1" - ("B16004e3" + "B16004e22" + "B16004e46")
 """
 
-SYSTEM_PROMPT = f"""You are a helpful US Census data analyst. You answer questions about US population, demographics, housing, commuting, migration, and language data using the 2019 American Community Survey.
 
-{SCHEMA_CONTEXT}
+@functools.cache
+def build_system_prompt(schema_context):
+    """Wrap a schema context in the analyst persona and rules."""
+    return f"""You are a helpful US Census data analyst. You answer questions about US population, demographics, housing, commuting, migration, and language data using the 2019 American Community Survey.
+
+{schema_context}
 
 RULES:
 1. ONLY answer questions related to US Census data, demographics, population, housing, commuting, migration, language, income, and related topics. For anything else, politely decline.
@@ -209,36 +241,547 @@ RULES:
 """
 
 
+SCHEMA_CONTEXT = build_schema_context(DB, SCHEMA)
+SYSTEM_PROMPT = build_system_prompt(SCHEMA_CONTEXT)
+
+
 # --- OpenAI client ---
+LLM_MODEL = "gpt-5.2"
+
+
+@functools.lru_cache(maxsize=1)
 def get_openai_client():
+    """Shared client, so its HTTP connection pool is reused across calls."""
     return OpenAI(api_key=OPENAI_API_KEY)
 
 
+_SQL_BLOCK_RE = re.compile(r"```sql\s*(.*?)\s*```", re.DOTALL)
+
+
 def extract_sql(text):
     """Extract SQL from ```sql ... ``` code blocks."""
-    pattern = r"```sql\s*(.*?)\s*```"
-    matches = re.findall(pattern, text, re.DOTALL)
-    return matches
+    return _SQL_BLOCK_RE.findall(text)
+
+
+# --- Persistent cache ---
+_CACHE_DB_LOCK = threading.Lock()
+# Entries are only valid for the prompt (and so the db.schema) and model that
+# produced them; anything written under another version is never served
+CACHE_VERSION = hashlib.sha256(f"{LLM_MODEL}\n{SYSTEM_PROMPT}".encode()).hexdigest()[:16]
+
+
+@functools.lru_cache(maxsize=1)
+def _cache_db():
+    """Open the SQLite cache at CACHE_DB_PATH, or return None when persistence is off.
+
+    Entries from other cache versions are purged on open.
+    """
+    if not CACHE_DB_PATH:
+        return None
+    db = sqlite3.connect(CACHE_DB_PATH, check_same_thread=False, isolation_level=None)
+    db.execute("PRAGMA journal_mode=WAL")
+    columns = {row[1] for row in db.execute("PRAGMA table_info(prompt_cache)")}
+    if columns and "version" not in columns:  # written before entries were versioned
+        db.execute("DROP TABLE prompt_cache")
+        db.execute("DROP TABLE IF EXISTS query_cache")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS prompt_cache (version TEXT, prompt_hash TEXT, "
+        "response TEXT, embedding BLOB, used REAL, PRIMARY KEY (version, prompt_hash))"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS query_cache (version TEXT, sql TEXT, max_rows INTEGER, "
+        "rows TEXT, PRIMARY KEY (version, sql, max_rows))"
+    )
+    for table in ("prompt_cache", "query_cache"):
+        db.execute(f"DELETE FROM {table} WHERE version != ?", (CACHE_VERSION,))
+    return db
+
+
+def _cache_db_execute(sql, params=()):
+    """Run one statement against the cache DB; a no-op returning [] when it's off."""
+    db = _cache_db()
+    if db is None:
+        return []
+    with _CACHE_DB_LOCK:
+        return db.execute(sql, params).fetchall()
+
+
+def _embedding_key(embedding):
+    return hashlib.sha256(embedding.tobytes()).hexdigest()
+
+
+# --- Semantic response cache ---
+EMBEDDING_MODEL = "text-embedding-3-small"
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_ENTRIES = 512
+
+
+def _load_semantic_cache():
+    """Warm the semantic cache from disk, least recently used first."""
+    rows = _cache_db_execute(
+        "SELECT embedding, response FROM ("
+        "SELECT embedding, response, used FROM prompt_cache WHERE version = ? "
+        "ORDER BY used DESC LIMIT ?) ORDER BY used",
+        (CACHE_VERSION, SEMANTIC_CACHE_MAX_ENTRIES),
+    )
+    return [(np.frombuffer(blob, dtype=np.float32), text) for blob, text in rows]
+
+
+_SEM_CACHE: list[tuple[np.ndarray, str]] = _load_semantic_cache()
+# Request/session threads share _SEM_CACHE; scoring and reordering must not interleave
+_SEM_CACHE_LOCK = threading.Lock()
+
+
+def embed_text(client, text):
+    """Return the L2-normalized embedding of text, or None if it can't be computed."""
+    try:
+        response = client.embeddings.create(model=EMBEDDING_MODEL, input=text)
+        vec = np.asarray(response.data[0].embedding, dtype=np.float32)
+    except Exception:
+        return None
+    norm = np.linalg.norm(vec)
+    if vec.ndim != 1 or norm == 0:
+        return None
+    return vec / norm
+
+
+def semantic_cache_lookup(client, messages):
+    """Look up a fresh single-question conversation in the semantic cache.
+
+    Returns (embedding, cached_response). embedding is None when the conversation
+    isn't cacheable — once there is history or query results in play, the answer
+    depends on more than the prompt. cached_response is None on a miss.
+    """
+    if len(messages) != 1 or messages[0]["role"] != "user":
+        return None, None
+    embedding = _embed_question(client, messages[0]["content"])
+    if embedding is None:
+        return embedding, None
+    with _SEM_CACHE_LOCK:
+        if not _SEM_CACHE:
+            return embedding, None
+        scores = np.stack([e for e, _ in _SEM_CACHE]) @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] <= SEMANTIC_CACHE_THRESHOLD:
+            return embedding, None
+        entry = _SEM_CACHE.pop(best)
+        _SEM_CACHE.append(entry)  # most recently used goes last
+    _cache_db_execute(
+        "UPDATE prompt_cache SET used = ? WHERE version = ? AND prompt_hash = ?",
+        (time.time(), CACHE_VERSION, _embedding_key(entry[0])),
+    )
+    return embedding, entry[1]
+
+
+def semantic_cache_store(embedding, response_text):
+    """Remember a response, evicting the least recently used entry when full."""
+    with _SEM_CACHE_LOCK:
+        _SEM_CACHE.append((embedding, response_text))
+        if len(_SEM_CACHE) > SEMANTIC_CACHE_MAX_ENTRIES:
+            del _SEM_CACHE[0]
+    embedding = np.asarray(embedding, dtype=np.float32)
+    _cache_db_execute(
+        "INSERT OR REPLACE INTO prompt_cache VALUES (?, ?, ?, ?, ?)",
+        (CACHE_VERSION, _embedding_key(embedding), response_text, embedding.tobytes(), time.time()),
+    )
+    _cache_db_execute(
+        "DELETE FROM prompt_cache WHERE version = ? AND prompt_hash NOT IN ("
+        "SELECT prompt_hash FROM prompt_cache WHERE version = ? ORDER BY used DESC LIMIT ?)",
+        (CACHE_VERSION, CACHE_VERSION, SEMANTIC_CACHE_MAX_ENTRIES),
+    )
+
+
+# --- Schema retrieval ---
+# Off unless SCHEMA_TOP_K is set: the ranked field lists are a small slice of the
+# prompt, and retrieval costs an embeddings call per turn and a topic-dependent
+# prompt that misses OpenAI's prefix cache.
+# Only the per-table "Key ..." field lists are ranked. Every "=== ..." section is
+# always on: between them they hold the qualified, quoted table names, the
+# quoting rules, the FIPS joins and the query recipes any question can need.
+SCHEMA_RANKED_PREFIX = "Key "
+_SCHEMA_SPLIT_RE = re.compile(r"(?m)^(?==== |Key )")
+
+
+class _EmbeddingFailed(Exception):
+    """Raised so lru_cache, which never caches exceptions, retries a failed embedding."""
+
+
+@functools.lru_cache(maxsize=64)
+def _cached_question_embedding(client, question):
+    embedding = embed_text(client, question)
+    if embedding is None:
+        raise _EmbeddingFailed
+    return embedding
+
+
+def _embed_question(client, question):
+    """Embed a question, or return None if that failed; only successes are memoized.
+
+    Shared by the semantic cache and schema retrieval, so every round of a turn
+    reuses one embeddings call.
+    """
+    try:
+        return _cached_question_embedding(client, question)
+    except _EmbeddingFailed:
+        return None
+
+
+@functools.cache
+def split_schema_context(schema_context):
+    """Split a schema context into always-on text and topic fragments.
+
+    Fragments are the per-table "Key ..." field lists; everything else is
+    always on. Concatenating everything in order reproduces the original context.
+    """
+    preamble, *pieces = _SCHEMA_SPLIT_RE.split(schema_context)
+    always_on = [(-1, preamble)]
+    fragments = []
+    for i, piece in enumerate(pieces):
+        (fragments if piece.startswith(SCHEMA_RANKED_PREFIX) else always_on).append((i, piece))
+    return tuple(always_on), tuple(fragments)
+
+
+@functools.lru_cache(maxsize=1)
+def _schema_fragment_vectors(client):
+    """Embed the SCHEMA_CONTEXT fragments once, as rows of a normalized matrix."""
+    _, fragments = split_schema_context(SCHEMA_CONTEXT)
+    response = client.embeddings.create(
+        model=EMBEDDING_MODEL, input=[text for _, text in fragments]
+    )
+    vectors = np.asarray([d.embedding for d in response.data], dtype=np.float32)
+    if vectors.shape[0] != len(fragments):
+        raise ValueError("embeddings response does not match the schema fragments")
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def _latest_question(messages):
+    for m in reversed(messages):
+        if m["role"] == "user" and not is_results_turn(m):
+            return m["content"]
+    return None
+
+
+def system_prompt_for(client, messages):
+    """System prompt with only the SCHEMA_TOP_K schema fragments relevant to the question.
+
+    Returns the full SYSTEM_PROMPT when retrieval is off, or when the question
+    or the schema can't be embedded.
+    """
+    if not SCHEMA_TOP_K:
+        return SYSTEM_PROMPT
+    question = _latest_question(messages)
+    embedding = _embed_question(client, question) if question else None
+    if embedding is None:
+        return SYSTEM_PROMPT
+    try:
+        vectors = _schema_fragment_vectors(client)
+    except Exception:
+        return SYSTEM_PROMPT
+    always_on, fragments = split_schema_context(SCHEMA_CONTEXT)
+    top = np.argsort(vectors @ embedding)[::-1][:SCHEMA_TOP_K]
+    picked = sorted([*always_on, *(fragments[i] for i in top)])
+    return build_system_prompt("".join(text for _, text in picked))
 
 
 def chat_with_llm(messages):
     """Send messages to OpenAI using the Responses API."""
     client = get_openai_client()
+    embedding, cached = semantic_cache_lookup(client, messages)
+    if cached is not None:
+        return cached
     response = client.responses.create(
-        model="gpt-5.2",
-        instructions=SYSTEM_PROMPT,
+        model=LLM_MODEL,
+        instructions=system_prompt_for(client, messages),
         input=messages,
     )
+    # A failed or incomplete (e.g. max_output_tokens) response is returned but never cached
+    if embedding is not None and response.status == "completed":
+        semantic_cache_store(embedding, response.output_text)
     return response.output_text
 
 
+def stream_chat_with_llm(messages):
+    """Like chat_with_llm, but yield the response text as the model generates it."""
+    client = get_openai_client()
+    embedding, cached = semantic_cache_lookup(client, messages)
+    if cached is not None:
+        yield cached
+        return
+    stream = client.responses.create(
+        model=LLM_MODEL,
+        instructions=system_prompt_for(client, messages),
+        input=messages,
+        stream=True,
+    )
+    chunks = []
+    completed = False  # response.failed / .incomplete end the stream without raising
+    for event in stream:
+        if event.type == "response.output_text.delta":
+            chunks.append(event.delta)
+            yield event.delta
+        elif event.type == "response.completed":
+            completed = True
+    if embedding is not None and completed:
+        semantic_cache_store(embedding, "".join(chunks))
+
+
+def tee_sql_blocks(chunks, on_sql):
+    """Pass text chunks through, calling on_sql(sql) as soon as each ```sql block closes.
+
+    Lets the caller start running a query while the model is still writing the
+    rest of its response.
+    """
+    text = ""
+    pos = 0  # end of the last closed block; nothing before it is rescanned
+    for chunk in chunks:
+        text += chunk
+        if "`" in chunk:
+            for m in _SQL_BLOCK_RE.finditer(text, pos):
+                on_sql(m.group(1))
+                pos = m.end()
+        yield chunk
+
+
+def batch_chat_with_llm(prompts, poll_interval=30):
+    """Answer many standalone prompts through the OpenAI Batch API.
+
+    Batch requests cost half as much but may take up to 24h, so this is for
+    offline work (prompt evaluation, regression runs) — not the chat UI.
+    Returns one response text per prompt, in order; None where a request failed.
+    """
+    client = get_openai_client()
+    lines = [
+        json.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": LLM_MODEL,
+                "messages": [
+                    {"role": "system", "content": SYSTEM_PROMPT},
+                    {"role": "user", "content": prompt},
+                ],
+            },
+        })
+        for i, prompt in enumerate(prompts)
+    ]
+    input_file = client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode()),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} ended with status {batch.status}")
+
+    results = [None] * len(prompts)
+    if batch.output_file_id:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            item = json.loads(line)
+            response = item.get("response")
+            if response and response["status_code"] == 200:
+                results[int(item["custom_id"])] = response["body"]["choices"][0]["message"]["content"]
+    return results
+
+
+def rows_to_csv(rows):
+    """Serialize query rows as CSV — column names once, then bare values — for the LLM.
+
+    SQL NULL is written as NULL, since csv would leave it indistinguishable
+    from an empty string.
+    """
+    if not rows:
+        return "(no rows)"
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator="\n")
+    writer.writerow(rows[0].keys())
+    writer.writerows(
+        ["NULL" if value is None else value for value in row.values()] for row in rows
+    )
+    return buf.getvalue().rstrip("\n")
+
+
+RESULTS_MESSAGE_PREFIX = "Here are the query results:"
+RESULTS_OMITTED = f"{RESULTS_MESSAGE_PREFIX} (omitted from the history to save tokens)"
+MAX_HISTORY_QUESTIONS = 8
+
+
+def build_results_message(results):
+    """Build the user turn that feeds query results back to the LLM for summarizing."""
+    results_text = "\n\n".join(
+        f"Query result {i + 1}:\n{r}" for i, r in enumerate(results)
+    )
+    return (
+        f"{RESULTS_MESSAGE_PREFIX}\n\n{results_text}\n\n"
+        "Please summarize these results in a clear, conversational way "
+        "to answer the user's question. Do not output any more SQL."
+    )
+
+
+def results_turn(results):
+    """The user turn that feeds query results back, as a list of input_text parts.
+
+    Typed questions are plain strings, so the list is what marks the turn as
+    results — whatever the user writes, it is never taken for one.
+    """
+    text = build_results_message(results)
+    return {"role": "user", "content": [{"type": "input_text", "text": text}]}
+
+
+def is_results_turn(message):
+    return message["role"] == "user" and not isinstance(message["content"], str)
+
+
+def compact_history(messages, max_questions=MAX_HISTORY_QUESTIONS):
+    """Shrink a finished conversation in place before the next question is added.
+
+    Raw query results are dropped — the model has already summarized them in its
+    answer — and only the last max_questions questions (with their replies) are
+    kept, so input tokens stay bounded however long the chat runs.
+    """
+    questions = []
+    for i, m in enumerate(messages):
+        if is_results_turn(m):
+            m["content"] = [{"type": "input_text", "text": RESULTS_OMITTED}]
+        elif m["role"] == "user":
+            questions.append(i)
+    if len(questions) > max_questions:
+        del messages[: questions[-max_questions]]
+
+
+# Upper bound on queries from one LLM response that run against Snowflake at once
+MAX_QUERY_WORKERS = 4
+# LLM <> Snowflake rounds one user message may take before the frontends give up
+MAX_CHAT_ROUNDS = 5
+
+
+# Quoted literals / identifiers, or a run of whitespace and comments outside of them
+_SQL_WHITESPACE_RE = re.compile(
+    r"""('(?:[^'\\]|\\.|'')*'|"(?:[^"]|"")*")|(?:\s|--[^\n]*|/\*.*?\*/)+""",
+    re.DOTALL,
+)
+
+
+def normalize_sql(sql):
+    """Canonical form of a query: comments, trailing semicolons and extra whitespace removed.
+
+    Inline comments are dropped before newlines are collapsed, so a -- comment
+    can't swallow the rest of the key. Text inside quoted strings and
+    identifiers is left alone.
+    """
+    stripped = _strip_sql_comments(sql).rstrip(";").rstrip()
+    return _SQL_WHITESPACE_RE.sub(lambda m: m.group(1) or " ", stripped).strip()
+
+
+# Normalized (sql, max_rows) -> rows, least recently used first. Keyed without
+# the connection so every pooled connection shares it and none are kept alive.
+QUERY_CACHE_SIZE = 256
+_QUERY_CACHE = collections.OrderedDict()
+_QUERY_CACHE_LOCK = threading.Lock()
+
+
+# Column types JSON can't round-trip, stored as {tag: str(value)} and rebuilt on
+# load. datetime comes before date, which it subclasses.
+_TAGGED_TYPES = (
+    ("$datetime", datetime.datetime, datetime.datetime.fromisoformat),
+    ("$date", datetime.date, datetime.date.fromisoformat),
+    ("$time", datetime.time, datetime.time.fromisoformat),
+    ("$decimal", decimal.Decimal, decimal.Decimal),
+)
+_TAG_PARSERS = {tag: parse for tag, _, parse in _TAGGED_TYPES}
+
+
+def _json_default(obj):
+    for tag, cls, _ in _TAGGED_TYPES:
+        if isinstance(obj, cls):
+            return {tag: str(obj)}
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _untag(value):
+    # Snowflake hands VARIANT/OBJECT columns over as JSON text, so a dict is always a tag
+    if isinstance(value, dict) and len(value) == 1:
+        (tag, text), = value.items()
+        if tag in _TAG_PARSERS:
+            return _TAG_PARSERS[tag](text)
+    return value
+
+
+def _persist_rows(sql_norm, max_rows, rows):
+    """Write query rows to the cache DB as JSON; rows it can't encode just stay in memory.
+
+    JSON rather than pickle, so a writable cache.db can't run code in the app.
+    Decimal and date/time values are tagged, so rows loaded after a restart
+    have the same types as fresh ones.
+    """
+    try:
+        encoded = orjson.dumps(
+            rows, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATETIME
+        ).decode()
+    except TypeError:
+        return
+    _cache_db_execute(
+        "INSERT OR REPLACE INTO query_cache VALUES (?, ?, ?, ?)",
+        (CACHE_VERSION, sql_norm, max_rows, encoded),
+    )
+
+
+def _load_rows(encoded):
+    return tuple(
+        {col: _untag(value) for col, value in row.items()} for row in orjson.loads(encoded)
+    )
+
+
+def _fetch_cached(sql, conn, max_rows):
+    """Run a query and memoize its rows under its normalized text — the ACS 2019 data never changes.
+
+    The normalized text is only the cache key; the original sql is what runs.
+    A DictCursor has the connector build each row dict natively while decoding
+    the Arrow result, instead of zipping tuples into dicts in Python.
+    Errors propagate, so failed queries are never cached. Closing the cursor
+    right after the first max_rows stops the connector from downloading and
+    decoding result chunks nobody will read (queries without a LIMIT).
+    With CACHE_DB_PATH set, results also survive restarts.
+    """
+    sql_norm = normalize_sql(sql)
+    key = (sql_norm, max_rows)
+    with _QUERY_CACHE_LOCK:
+        if key in _QUERY_CACHE:
+            _QUERY_CACHE.move_to_end(key)
+            return _QUERY_CACHE[key]
+
+    stored = _cache_db_execute(
+        "SELECT rows FROM query_cache WHERE version = ? AND sql = ? AND max_rows = ?",
+        (CACHE_VERSION, *key),
+    )
+    if stored:
+        rows = _load_rows(stored[0][0])
+    else:
+        cur = conn.cursor(DictCursor)
+        try:
+            cur.execute(sql)
+            rows = tuple(cur.fetchmany(max_rows))
+        finally:
+            cur.close()
+        _persist_rows(sql_norm, max_rows, rows)
+
+    with _QUERY_CACHE_LOCK:
+        _QUERY_CACHE[key] = rows
+        if len(_QUERY_CACHE) > QUERY_CACHE_SIZE:
+            _QUERY_CACHE.popitem(last=False)
+    return rows
+
+
 def run_query(sql, conn, max_rows=500):
     """Execute a read-only SQL query and return results as list of dicts."""
     try:
-        cur = conn.cursor()
-        cur.execute(sql)
-        columns = [desc[0] for desc in cur.description]
-        rows = cur.fetchmany(max_rows)
-        return [dict(zip(columns, row)) for row in rows]
+        rows = _fetch_cached(sql, conn, max_rows)
     except Exception as e:
         return {"error": str(e)}
+    return list(map(dict, rows))  # copies, so callers can't mutate the cache
@@ -1,34 +1,97 @@
 """Flask frontend for Census Chat — local testing alternative to Streamlit."""
 
+import datetime
+import decimal
+import json
+import queue
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
 
+import orjson
 import snowflake.connector
 from flask import Flask, jsonify, render_template, request, session
+from flask.json.provider import JSONProvider
+from werkzeug.http import http_date
 
 from core import (
+    MAX_CHAT_ROUNDS,
+    MAX_QUERY_WORKERS,
     SF_CONFIG,
     SYSTEM_PROMPT,
     chat_with_llm,
+    compact_history,
     extract_sql,
     is_off_topic,
     is_safe_sql,
+    results_turn,
+    rows_to_csv,
     run_query,
 )
 
+
+# ---------------------------------------------------------------------------
+# JSON — orjson serializes the query-result steps far faster than stdlib json
+# ---------------------------------------------------------------------------
+def _json_default(obj):
+    # Match Flask's default provider: Decimal as str, dates as HTTP dates
+    if isinstance(obj, decimal.Decimal):
+        return str(obj)
+    if isinstance(obj, datetime.date):  # datetime too
+        return http_date(obj)
+    if isinstance(obj, datetime.time):
+        return obj.isoformat()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def _dumps(obj):
+    try:
+        return orjson.dumps(obj, default=_json_default, option=orjson.OPT_PASSTHROUGH_DATETIME)
+    except orjson.JSONEncodeError:
+        # orjson rejects integers beyond 64 bits, which NUMBER(38,0) aggregates can reach
+        return json.dumps(obj, default=_json_default).encode()
+
+
+class OrjsonProvider(JSONProvider):
+    def dumps(self, obj, **kwargs):
+        return _dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # jsonify's convention: one value as is, several as a list, or keywords as a dict
+        if args and kwargs:
+            raise TypeError("jsonify() behavior undefined when passed both args and kwargs")
+        obj = args[0] if len(args) == 1 else (args or kwargs or None)
+        return self._app.response_class(_dumps(obj), mimetype="application/json")
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 app.secret_key = "census-chat-dev-key"
 
 # ---------------------------------------------------------------------------
-# Snowflake connection — lazy singleton with reconnect
+# Snowflake connections — bounded pool, connected lazily, reconnect when closed
 # ---------------------------------------------------------------------------
-_sf_conn = None
+SF_POOL_SIZE = 8
+
+# Each slot holds a connection, or None until it is first checked out
+_sf_pool: queue.LifoQueue = queue.LifoQueue(maxsize=SF_POOL_SIZE)
+for _ in range(SF_POOL_SIZE):
+    _sf_pool.put(None)
 
 
+@contextmanager
 def get_snowflake_connection():
-    global _sf_conn
-    if _sf_conn is None or _sf_conn.is_closed():
-        _sf_conn = snowflake.connector.connect(**SF_CONFIG)
-    return _sf_conn
+    """Check a connection out of the pool; blocks while all of them are in use."""
+    conn = _sf_pool.get()
+    try:
+        if conn is None or conn.is_closed():
+            conn = snowflake.connector.connect(**SF_CONFIG)
+        yield conn
+    finally:
+        _sf_pool.put(conn)
 
 
 # ---------------------------------------------------------------------------
@@ -46,45 +109,19 @@ def _get_messages() -> list[dict]:
 
 
 # ---------------------------------------------------------------------------
-# Routes
+# Chat pipeline — LLM <> Snowflake rounds for one user message
 # ---------------------------------------------------------------------------
-@app.route("/")
-def index():
-    # Ensure session has an id on first visit
-    if "sid" not in session:
-        session["sid"] = str(uuid.uuid4())
-    return render_template("index.html")
-
-
-@app.route("/chat", methods=["POST"])
-def chat():
-    data = request.get_json(force=True)
-    user_text = (data.get("message") or "").strip()
-    if not user_text:
-        return jsonify(error="Empty message"), 400
-
-    # Guardrail
-    if is_off_topic(user_text):
-        return jsonify(steps=[{
-            "type": "answer",
-            "content": "I can only answer questions about US Census and population data. "
-                       "Please ask something related to demographics, housing, commuting, "
-                       "migration, or language statistics.",
-        }])
-
-    messages = _get_messages()
-    messages.append({"role": "user", "content": user_text})
-
-    # Build LLM conversation
-    llm_messages = [{"role": m["role"], "content": m["content"]} for m in messages]
+def _run_chat_rounds(messages: list[dict], conn_future, pool) -> list[dict]:
+    """Let the LLM answer the conversation, running its SQL on pool; returns the steps.
 
+    conn_future resolves to the Snowflake connection, which is only waited on
+    once the model actually emits SQL.
+    """
     steps: list[dict] = []
-    conn = get_snowflake_connection()
-    max_rounds = 5
 
-    for _ in range(max_rounds):
+    for _ in range(MAX_CHAT_ROUNDS):
         try:
-            response_text = chat_with_llm(llm_messages)
+            response_text = chat_with_llm(messages)
         except Exception as exc:
             steps.append({"type": "error", "content": str(exc)})
             break
@@ -101,39 +138,88 @@ def chat():
         steps.append({"type": "llm_response", "content": response_text})
         messages.append({"role": "assistant", "content": response_text})
 
+        # Run the safe queries concurrently, then report them in order. A failed
+        # checkout or connect is reported like a failed query, so the model sees
+        # it and the stored SQL turn still gets its results message.
+        try:
+            conn = conn_future.result()
+            conn_failed = None
+        except Exception as exc:
+            conn_failed = Future()
+            conn_failed.set_result({"error": f"Could not connect to Snowflake: {exc}"})
+        futures = [
+            (conn_failed or pool.submit(run_query, sql, conn)) if is_safe_sql(sql) else None
+            for sql in sql_queries
+        ]
         all_results = []
-        for sql in sql_queries:
-            if not is_safe_sql(sql):
+        for future in futures:
+            if future is None:
                 msg = "That query was blocked for safety reasons. I can only run SELECT queries."
                 steps.append({"type": "query_error", "content": msg})
                 all_results.append(msg)
                 continue
 
-            result = run_query(sql, conn)
+            result = future.result()
             if isinstance(result, dict) and "error" in result:
                 steps.append({"type": "query_error", "content": result["error"]})
                 all_results.append(f"Query error: {result['error']}")
             else:
                 steps.append({"type": "query_result", "content": result})
-                all_results.append(str(result))
-
-        # Feed results back for summarisation
-        results_text = "\n\n".join(
-            f"Query result {i + 1}:\n{r}" for i, r in enumerate(all_results)
-        )
-        result_message = (
-            f"Here are the query results:\n\n{results_text}\n\n"
-            "Please summarize these results in a clear, conversational way "
-            "to answer the user's question. Do not output any more SQL."
-        )
-        llm_messages.append({"role": "assistant", "content": response_text})
-        llm_messages.append({"role": "user", "content": result_message})
+                all_results.append(rows_to_csv(result))
+
+        # Feed results back for summarisation. The results turn stays in full
+        # for the rest of this request, so each round extends the last one
+        # verbatim; compact_history trims it before the next question.
+        messages.append(results_turn(all_results))
     else:
         steps.append({
             "type": "error",
             "content": "I had trouble completing that query. Could you try rephrasing your question?",
         })
 
+    return steps
+
+
+# ---------------------------------------------------------------------------
+# Routes
+# ---------------------------------------------------------------------------
+@app.route("/")
+def index():
+    # Ensure session has an id on first visit
+    if "sid" not in session:
+        session["sid"] = str(uuid.uuid4())
+    return render_template("index.html")
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    data = request.get_json(force=True)
+    user_text = (data.get("message") or "").strip()
+    if not user_text:
+        return jsonify(error="Empty message"), 400
+
+    # Guardrail
+    if is_off_topic(user_text):
+        return jsonify(steps=[{
+            "type": "answer",
+            "content": "I can only answer questions about US Census and population data. "
+                       "Please ask something related to demographics, housing, commuting, "
+                       "migration, or language statistics.",
+        }])
+
+    # The stored conversation is the LLM transcript itself — append to it, never
+    # rebuild. Only finished turns get compacted, so each round within this
+    # request still extends the previous one verbatim.
+    messages = _get_messages()
+    compact_history(messages)
+    messages.append({"role": "user", "content": user_text})
+
+    # Check out (and on a cold slot, open) the Snowflake connection in the
+    # background so it overlaps the first LLM round. The stack returns it to
+    # the pool only after the executor has finished every query.
+    with ExitStack() as stack, ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS) as pool:
+        conn_future = pool.submit(stack.enter_context, get_snowflake_connection())
+        steps = _run_chat_rounds(messages, conn_future, pool)
     return jsonify(steps=steps)
 
 
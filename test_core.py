@@ -1,27 +1,19 @@
 """Unit tests for core.py — shared pure logic module."""
 
+import datetime
+import decimal
+import json
 import os
-import pytest
-from unittest.mock import patch, MagicMock
-
+import threading
+from types import SimpleNamespace
+from unittest.mock import Mock, patch
 
-@pytest.fixture(autouse=True)
-def set_env(monkeypatch):
-    """Set env vars before importing core."""
-    monkeypatch.setenv("SNOWFLAKE_ACCOUNT", "test_account")
-    monkeypatch.setenv("SNOWFLAKE_USER", "test_user")
-    monkeypatch.setenv("SNOWFLAKE_PASSWORD", "test_password")
-    monkeypatch.setenv("SNOWFLAKE_DATABASE", "TEST_DB")
-    monkeypatch.setenv("SNOWFLAKE_SCHEMA", "TEST_SCHEMA")
-    monkeypatch.setenv("SNOWFLAKE_WAREHOUSE", "TEST_WH")
-    monkeypatch.setenv("OPENAI_API_KEY", "sk-test-key")
+import pytest
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def core():
-    import importlib
     import core as core_module
-    importlib.reload(core_module)
     return core_module
 
 
@@ -91,84 +83,60 @@ class TestStripSqlComments:
         result = core._strip_sql_comments(sql)
         assert result == "SELECT 1"
 
+    def test_line_comment_after_block_comment(self, core):
+        sql = "/* block */ -- line\nSELECT 1"
+        assert core._strip_sql_comments(sql) == "SELECT 1"
 
-# ===================== is_safe_sql =====================
-
-class TestIsSafeSql:
-    def test_select(self, core):
-        assert core.is_safe_sql("SELECT * FROM t") is True
-
-    def test_with_cte(self, core):
-        assert core.is_safe_sql("WITH cte AS (SELECT 1) SELECT * FROM cte") is True
-
-    def test_trailing_semicolons(self, core):
-        assert core.is_safe_sql("SELECT 1;") is True
-        assert core.is_safe_sql("SELECT 1;;;") is True
-
-    def test_drop_blocked(self, core):
-        assert core.is_safe_sql("DROP TABLE t") is False
-
-    def test_delete_blocked(self, core):
-        assert core.is_safe_sql("DELETE FROM t") is False
-
-    def test_insert_blocked(self, core):
-        assert core.is_safe_sql("INSERT INTO t VALUES (1)") is False
-
-    def test_update_blocked(self, core):
-        assert core.is_safe_sql("UPDATE t SET x=1") is False
-
-    def test_alter_blocked(self, core):
-        assert core.is_safe_sql("ALTER TABLE t ADD col INT") is False
-
-    def test_create_blocked(self, core):
-        assert core.is_safe_sql("CREATE TABLE t (id INT)") is False
-
-    def test_truncate_blocked(self, core):
-        assert core.is_safe_sql("TRUNCATE TABLE t") is False
-
-    def test_replace_blocked(self, core):
-        assert core.is_safe_sql("REPLACE INTO t VALUES (1)") is False
-
-    def test_merge_blocked(self, core):
-        assert core.is_safe_sql("MERGE INTO t USING s ON t.id=s.id") is False
-
-    def test_grant_blocked(self, core):
-        assert core.is_safe_sql("GRANT ALL ON db TO user") is False
-
-    def test_revoke_blocked(self, core):
-        assert core.is_safe_sql("REVOKE ALL ON db FROM user") is False
-
-    def test_exec_blocked(self, core):
-        assert core.is_safe_sql("EXEC sp_helpdb") is False
-
-    def test_execute_blocked(self, core):
-        assert core.is_safe_sql("EXECUTE sp_helpdb") is False
-
-    def test_select_with_embedded_drop(self, core):
-        assert core.is_safe_sql("SELECT 1; DROP TABLE t") is False
-
-    def test_select_subquery_with_dangerous_keyword_in_name(self, core):
-        """A column alias or string containing 'update' should still be caught."""
-        assert core.is_safe_sql("SELECT 'update' FROM t") is False
+    def test_line_comment_without_newline(self, core):
+        assert core._strip_sql_comments("-- only a comment") == ""
 
-    def test_empty(self, core):
-        assert core.is_safe_sql("") is False
 
-    def test_whitespace_only(self, core):
-        assert core.is_safe_sql("   ") is False
-
-    def test_show_tables(self, core):
-        assert core.is_safe_sql("SHOW TABLES") is False
+# ===================== is_safe_sql =====================
 
-    def test_comment_hiding_drop(self, core):
-        assert core.is_safe_sql("-- sneaky\nDROP TABLE t") is False
+class TestIsSafeSql:
+    @pytest.mark.parametrize("sql", [
+        pytest.param("SELECT * FROM t", id="select"),
+        pytest.param("WITH cte AS (SELECT 1) SELECT * FROM cte", id="with_cte"),
+        pytest.param("SELECT 1;", id="trailing_semicolon"),
+        pytest.param("SELECT 1;;;", id="trailing_semicolons"),
+        pytest.param("select col from t", id="lowercase"),
+        pytest.param("Select Col From T", id="mixed_case"),
+        pytest.param("SELECT created_at, last_update FROM t", id="keyword_inside_identifier"),
+    ])
+    def test_allowed(self, core, sql):
+        assert core.is_safe_sql(sql) is True
+
+    @pytest.mark.parametrize("sql", [
+        pytest.param("DROP TABLE t", id="drop"),
+        pytest.param("DELETE FROM t", id="delete"),
+        pytest.param("INSERT INTO t VALUES (1)", id="insert"),
+        pytest.param("UPDATE t SET x=1", id="update"),
+        pytest.param("ALTER TABLE t ADD col INT", id="alter"),
+        pytest.param("CREATE TABLE t (id INT)", id="create"),
+        pytest.param("TRUNCATE TABLE t", id="truncate"),
+        pytest.param("REPLACE INTO t VALUES (1)", id="replace"),
+        pytest.param("MERGE INTO t USING s ON t.id=s.id", id="merge"),
+        pytest.param("GRANT ALL ON db TO user", id="grant"),
+        pytest.param("REVOKE ALL ON db FROM user", id="revoke"),
+        pytest.param("EXEC sp_helpdb", id="exec"),
+        pytest.param("EXECUTE sp_helpdb", id="execute"),
+        pytest.param("SELECT 1; DROP TABLE t", id="select_with_embedded_drop"),
+        # A column alias or string containing 'update' should still be caught
+        pytest.param("SELECT 'update' FROM t", id="dangerous_keyword_in_string"),
+        pytest.param("select 1; drop table t", id="lowercase_keyword_after_select"),
+        pytest.param("", id="empty"),
+        pytest.param("   ", id="whitespace_only"),
+        pytest.param("SHOW TABLES", id="show_tables"),
+        pytest.param("-- sneaky\nDROP TABLE t", id="comment_hiding_drop"),
+        pytest.param("/* sneaky */ DROP TABLE t", id="block_comment_hiding_drop"),
+    ])
+    def test_blocked(self, core, sql):
+        assert core.is_safe_sql(sql) is False
 
-    def test_block_comment_hiding_drop(self, core):
-        assert core.is_safe_sql("/* sneaky */ DROP TABLE t") is False
-
-    def test_case_insensitive(self, core):
-        assert core.is_safe_sql("select col from t") is True
-        assert core.is_safe_sql("Select Col From T") is True
+    def test_repeated_sql_is_memoized(self, core):
+        core.is_safe_sql("SELECT 1")
+        core.is_safe_sql("SELECT 1")
+        assert core.is_safe_sql.cache_info().hits == 1
 
 
 # ===================== is_off_topic =====================
@@ -205,42 +173,33 @@ class TestIsOffTopic:
         assert core.is_off_topic("DRUGS") is True
         assert core.is_off_topic("Bomb") is True
 
+    def test_repeated_text_is_memoized(self, core):
+        core.is_off_topic("population of Texas")
+        core.is_off_topic("population of Texas")
+        assert core.is_off_topic.cache_info().hits == 1
+
 
 # ===================== extract_sql =====================
 
 class TestExtractSql:
-    def test_single_block(self, core):
-        text = "Here:\n```sql\nSELECT 1\n```\nDone."
-        result = core.extract_sql(text)
-        assert len(result) == 1
-        assert "SELECT 1" in result[0]
-
-    def test_multiple_blocks(self, core):
-        text = "A:\n```sql\nSELECT a\n```\nB:\n```sql\nSELECT b\n```"
-        result = core.extract_sql(text)
-        assert len(result) == 2
-
-    def test_no_sql(self, core):
-        assert core.extract_sql("No SQL here.") == []
-
-    def test_python_block_ignored(self, core):
-        assert core.extract_sql("```python\nprint(1)\n```") == []
-
-    def test_empty_sql_block(self, core):
-        result = core.extract_sql("```sql\n```")
-        assert len(result) == 1
-
-    def test_multiline_sql(self, core):
-        text = "```sql\nSELECT\n  a,\n  b\nFROM t\n```"
-        result = core.extract_sql(text)
-        assert len(result) == 1
-        assert "FROM t" in result[0]
-
-    def test_sql_with_backticks_inside(self, core):
-        """SQL that has inner content but no nested triple-backtick."""
-        text = '```sql\nSELECT "col" FROM t WHERE x = \'abc\'\n```'
+    # (text, one expected substring per extracted block)
+    @pytest.mark.parametrize("text, expected", [
+        pytest.param("Here:\n```sql\nSELECT 1\n```\nDone.", ["SELECT 1"], id="single_block"),
+        pytest.param("A:\n```sql\nSELECT a\n```\nB:\n```sql\nSELECT b\n```",
+                     ["SELECT a", "SELECT b"], id="multiple_blocks"),
+        pytest.param("No SQL here.", [], id="no_sql"),
+        pytest.param("```python\nprint(1)\n```", [], id="python_block_ignored"),
+        pytest.param("```sql\n```", [""], id="empty_sql_block"),
+        pytest.param("```sql\nSELECT\n  a,\n  b\nFROM t\n```", ["FROM t"], id="multiline_sql"),
+        # SQL that has inner content but no nested triple-backtick
+        pytest.param('```sql\nSELECT "col" FROM t WHERE x = \'abc\'\n```', ['"col"'],
+                     id="sql_with_quotes_inside"),
+    ])
+    def test_extract(self, core, text, expected):
         result = core.extract_sql(text)
-        assert len(result) == 1
+        assert len(result) == len(expected)
+        for block, substring in zip(result, expected):
+            assert substring in block
 
 
 # ===================== SCHEMA_CONTEXT / SYSTEM_PROMPT =====================
@@ -276,26 +235,37 @@ class TestSchemaContextAndPrompt:
         assert "ONLY answer questions related to US Census" in core.SYSTEM_PROMPT
         assert "NEVER generate SQL that modifies data" in core.SYSTEM_PROMPT
 
+    def test_builders_are_cached(self, core):
+        context = core.build_schema_context("OTHER_DB", "OTHER_SCHEMA")
+        assert 'OTHER_DB.OTHER_SCHEMA."2019_CBG_B08"' in context
+        assert core.build_schema_context("OTHER_DB", "OTHER_SCHEMA") is context
+        assert core.build_system_prompt(core.SCHEMA_CONTEXT) is core.SYSTEM_PROMPT
+
 
 # ===================== get_openai_client =====================
 
 class TestGetOpenaiClient:
     def test_returns_openai_client(self, core):
         with patch("core.OpenAI") as mock_cls:
-            mock_cls.return_value = MagicMock()
+            mock_cls.return_value = Mock()
             client = core.get_openai_client()
             mock_cls.assert_called_once_with(api_key=core.OPENAI_API_KEY)
             assert client is mock_cls.return_value
 
+    def test_client_is_reused(self, core):
+        with patch("core.OpenAI") as mock_cls:
+            first = core.get_openai_client()
+            second = core.get_openai_client()
+        mock_cls.assert_called_once()
+        assert first is second
+
 
 # ===================== chat_with_llm =====================
 
 class TestChatWithLlm:
     def test_calls_responses_api(self, core):
-        mock_client = MagicMock()
-        mock_response = MagicMock()
-        mock_response.output_text = "Answer."
-        mock_client.responses.create.return_value = mock_response
+        mock_client = Mock()
+        mock_client.responses.create.return_value = SimpleNamespace(output_text="Answer.")
 
         with patch.object(core, "get_openai_client", return_value=mock_client):
             msgs = [{"role": "user", "content": "hi"}]
@@ -308,7 +278,7 @@ class TestChatWithLlm:
         assert call_kwargs["input"] == msgs
 
     def test_propagates_exception(self, core):
-        mock_client = MagicMock()
+        mock_client = Mock()
         mock_client.responses.create.side_effect = RuntimeError("API down")
 
         with patch.object(core, "get_openai_client", return_value=mock_client):
@@ -316,24 +286,477 @@ class TestChatWithLlm:
                 core.chat_with_llm([{"role": "user", "content": "hi"}])
 
 
+# ===================== semantic cache =====================
+
+def _embedding_client(vectors, output_text="Answer.", schema_vectors=None):
+    """Mock client whose embeddings.create returns each question vector in turn.
+
+    Batch (schema fragment) requests get schema_vectors, or fail when None.
+    """
+    questions = iter(vectors)
+
+    def create(model, input):
+        if isinstance(input, list):
+            if schema_vectors is None:
+                raise RuntimeError("schema embeddings unavailable")
+            return SimpleNamespace(data=[SimpleNamespace(embedding=v) for v in schema_vectors])
+        return SimpleNamespace(data=[SimpleNamespace(embedding=next(questions))])
+
+    mock_client = Mock()
+    mock_client.embeddings.create.side_effect = create
+    mock_client.responses.create.return_value = SimpleNamespace(
+        output_text=output_text, status="completed"
+    )
+    return mock_client
+
+
+class TestSemanticCache:
+    def test_incomplete_response_is_not_cached(self, core):
+        mock_client = _embedding_client([[1.0, 0.0], [1.0, 0.0]])
+        mock_client.responses.create.side_effect = [
+            SimpleNamespace(output_text="Let me que", status="incomplete"),
+            SimpleNamespace(output_text="Full answer.", status="completed"),
+        ]
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            assert core.chat_with_llm([{"role": "user", "content": "hi"}]) == "Let me que"
+            assert core.chat_with_llm([{"role": "user", "content": "hi"}]) == "Full answer."
+
+        assert [text for _, text in core._SEM_CACHE] == ["Full answer."]
+
+    def test_similar_prompt_hits_cache(self, core):
+        mock_client = _embedding_client([[1.0, 0.0], [0.99, 0.05]])
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            first = core.chat_with_llm([{"role": "user", "content": "population of Texas"}])
+            second = core.chat_with_llm([{"role": "user", "content": "Texas population"}])
+
+        assert first == second == "Answer."
+        mock_client.responses.create.assert_called_once()
+
+    def test_dissimilar_prompt_misses_cache(self, core):
+        mock_client = _embedding_client([[1.0, 0.0], [0.0, 1.0]])
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            core.chat_with_llm([{"role": "user", "content": "population of Texas"}])
+            core.chat_with_llm([{"role": "user", "content": "commute times"}])
+
+        assert mock_client.responses.create.call_count == 2
+
+    def test_multi_message_conversation_not_cached(self, core):
+        mock_client = _embedding_client([[1.0, 0.0]])
+        msgs = [
+            {"role": "user", "content": "hi"},
+            {"role": "assistant", "content": "hello"},
+            {"role": "user", "content": "population of Texas"},
+        ]
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            core.chat_with_llm(msgs)
+
+        assert core._SEM_CACHE == []
+
+    def test_embedding_failure_falls_back_to_llm(self, core):
+        mock_client = _embedding_client([])
+        mock_client.embeddings.create.side_effect = RuntimeError("embeddings down")
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            result = core.chat_with_llm([{"role": "user", "content": "hi"}])
+
+        assert result == "Answer."
+        assert core._SEM_CACHE == []
+
+    def test_cache_is_bounded(self, core, monkeypatch):
+        monkeypatch.setattr(core, "SEMANTIC_CACHE_MAX_ENTRIES", 2)
+        for i in range(3):
+            core.semantic_cache_store(core.np.eye(3, dtype=core.np.float32)[i], f"r{i}")
+        assert [text for _, text in core._SEM_CACHE] == ["r1", "r2"]
+
+    def test_store_waits_for_a_lookup_in_progress(self, core, monkeypatch):
+        """An eviction mid-lookup would shift indices and return another question's answer."""
+        monkeypatch.setattr(core, "SEMANTIC_CACHE_MAX_ENTRIES", 2)
+        eye = core.np.eye(3, dtype=core.np.float32)
+        core.semantic_cache_store(eye[0], "other")
+        core.semantic_cache_store(eye[1], "match")
+        real_stack = core.np.stack
+        store = threading.Thread(target=core.semantic_cache_store, args=(eye[2], "new"))
+
+        def stack_while_storing(arrays):
+            store.start()
+            store.join(timeout=0.1)  # blocked on the cache lock, so nothing shifts
+            return real_stack(arrays)
+
+        mock_client = _embedding_client([[0.0, 1.0, 0.0]])
+        with patch.object(core.np, "stack", side_effect=stack_while_storing):
+            _, cached = core.semantic_cache_lookup(mock_client, [{"role": "user", "content": "q"}])
+        store.join()
+
+        assert cached == "match"
+        assert [text for _, text in core._SEM_CACHE] == ["match", "new"]
+
+
+# ===================== schema retrieval =====================
+
+class TestSystemPromptFor:
+    @pytest.fixture(autouse=True)
+    def retrieval_on(self, core, monkeypatch):
+        monkeypatch.setattr(core, "SCHEMA_TOP_K", 1)
+
+    def _schema_vectors(self, core, favored):
+        """One-hot fragment vectors, with the favored fragments all along axis 0."""
+        _, fragments = core.split_schema_context(core.SCHEMA_CONTEXT)
+        vectors = []
+        for i, (_, text) in enumerate(fragments):
+            vec = [0.0] * (len(fragments) + 1)
+            vec[0 if any(text.startswith(f) for f in favored) else i + 1] = 1.0
+            vectors.append(vec)
+        return vectors
+
+    def test_split_reassembles_schema(self, core):
+        always_on, fragments = core.split_schema_context(core.SCHEMA_CONTEXT)
+        pieces = sorted([*always_on, *fragments])
+        assert "".join(text for _, text in pieces) == core.SCHEMA_CONTEXT
+
+    def test_only_field_lists_are_ranked(self, core):
+        _, fragments = core.split_schema_context(core.SCHEMA_CONTEXT)
+        assert [text.split(" (")[0] for _, text in fragments] == ["Key B08", "Key B07", "Key B16"]
+
+    def test_keeps_relevant_fragment_and_always_on(self, core):
+        schema = self._schema_vectors(core, ("Key B16",))
+        question = [1.0] + [0.0] * (len(schema[0]) - 1)
+        mock_client = _embedding_client([question], schema_vectors=schema)
+        msgs = [{"role": "user", "content": "which states speak the most Spanish"}]
+
+        prompt = core.system_prompt_for(mock_client, msgs)
+
+        assert "Key B16 (Language)" in prompt
+        assert "Key B08 (Commuting)" not in prompt
+        assert "NEVER generate SQL that modifies data" in prompt
+        assert len(prompt) < len(core.SYSTEM_PROMPT)
+
+    @pytest.mark.parametrize("rule", [
+        "=== CRITICAL: COLUMN QUOTING RULES ===",
+        "MUST be double-quoted",
+        'TEST_DB.TEST_SCHEMA."2019_CBG_B08"',
+        "LEFT(CENSUS_BLOCK_GROUP, 2) = STATE_FIPS",
+        '"B08135e1" IS NOT NULL',
+        "over 30% of income on rent",
+    ])
+    def test_quoting_and_join_rules_survive_any_ranking(self, core, rule):
+        schema = self._schema_vectors(core, ("Key B07",))
+        question = [1.0] + [0.0] * (len(schema[0]) - 1)
+        mock_client = _embedding_client([question], schema_vectors=schema)
+        msgs = [{"role": "user", "content": "how many people moved from another state"}]
+
+        assert rule in core.system_prompt_for(mock_client, msgs)
+
+    def test_question_embedded_once_per_turn(self, core):
+        schema = self._schema_vectors(core, ())
+        question = [1.0] + [0.0] * (len(schema[0]) - 1)
+        mock_client = _embedding_client([question], schema_vectors=schema)
+        msgs = [
+            {"role": "user", "content": "commute times"},
+            {"role": "assistant", "content": "```sql\nSELECT 1\n```"},
+            core.results_turn(["x"]),
+        ]
+
+        first = core.system_prompt_for(mock_client, msgs[:1])
+        second = core.system_prompt_for(mock_client, msgs)
+
+        assert first == second
+        assert mock_client.embeddings.create.call_count == 2  # question + schema
+
+    def test_falls_back_to_full_prompt(self, core):
+        mock_client = _embedding_client([[1.0, 0.0]])
+        msgs = [{"role": "user", "content": "commute times"}]
+        assert core.system_prompt_for(mock_client, msgs) == core.SYSTEM_PROMPT
+
+    def test_top_k_is_read_from_env(self, core, monkeypatch):
+        import importlib
+
+        monkeypatch.setenv("SCHEMA_TOP_K", "2")
+        assert importlib.reload(core).SCHEMA_TOP_K == 2
+        monkeypatch.setenv("SCHEMA_TOP_K", "")
+        assert importlib.reload(core).SCHEMA_TOP_K == 0
+
+    def test_off_by_default_without_embedding(self, core, monkeypatch):
+        monkeypatch.setattr(core, "SCHEMA_TOP_K", 0)
+        mock_client = _embedding_client([])
+        msgs = [{"role": "user", "content": "commute times"}]
+
+        assert core.system_prompt_for(mock_client, msgs) == core.SYSTEM_PROMPT
+        mock_client.embeddings.create.assert_not_called()
+
+    def test_failed_question_embedding_is_retried(self, core):
+        mock_client = Mock()
+        mock_client.embeddings.create.side_effect = [
+            RuntimeError("blip"),
+            SimpleNamespace(data=[SimpleNamespace(embedding=[1.0, 0.0])]),
+        ]
+
+        assert core._embed_question(mock_client, "commute times") is None
+        assert core._embed_question(mock_client, "commute times") is not None
+        assert core._embed_question(mock_client, "commute times") is not None
+        assert mock_client.embeddings.create.call_count == 2
+
+
+# ===================== stream_chat_with_llm =====================
+
+def _delta(text):
+    return SimpleNamespace(type="response.output_text.delta", delta=text)
+
+
+class TestStreamChatWithLlm:
+    def test_yields_text_deltas(self, core):
+        mock_client = Mock()
+        mock_client.responses.create.return_value = iter([
+            SimpleNamespace(type="response.created"),
+            _delta("Hello"),
+            _delta(" world."),
+            SimpleNamespace(type="response.completed"),
+        ])
+
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            msgs = [{"role": "user", "content": "hi"}]
+            chunks = list(core.stream_chat_with_llm(msgs))
+
+        assert chunks == ["Hello", " world."]
+        call_kwargs = mock_client.responses.create.call_args[1]
+        assert call_kwargs["stream"] is True
+        assert call_kwargs["instructions"] == core.SYSTEM_PROMPT
+        assert call_kwargs["input"] == msgs
+
+    def test_full_response_is_cached(self, core):
+        mock_client = _embedding_client([[1.0, 0.0], [1.0, 0.0]])
+        mock_client.responses.create.return_value = iter([
+            _delta("Hello"), _delta(" world."), SimpleNamespace(type="response.completed"),
+        ])
+
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            msgs = [{"role": "user", "content": "hi"}]
+            list(core.stream_chat_with_llm(msgs))
+            assert list(core.stream_chat_with_llm(msgs)) == ["Hello world."]
+
+        mock_client.responses.create.assert_called_once()
+
+    @pytest.mark.parametrize("end", ["response.incomplete", "response.failed"])
+    def test_truncated_response_is_not_cached(self, core, end):
+        mock_client = _embedding_client([[1.0, 0.0], [1.0, 0.0]])
+        mock_client.responses.create.side_effect = [
+            iter([_delta("Let me que"), SimpleNamespace(type=end)]),
+            iter([_delta("Full answer."), SimpleNamespace(type="response.completed")]),
+        ]
+
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            msgs = [{"role": "user", "content": "hi"}]
+            assert list(core.stream_chat_with_llm(msgs)) == ["Let me que"]
+            assert list(core.stream_chat_with_llm(msgs)) == ["Full answer."]
+
+        assert core._SEM_CACHE[0][1] == "Full answer."
+
+
+class TestTeeSqlBlocks:
+    def test_fires_when_block_closes(self, core):
+        chunks = ["Let me check:\n``", "`sql\nSELECT ", "1\n``", "`\nThen summarize."]
+        fired = []
+        passed = []
+        for chunk in core.tee_sql_blocks(chunks, fired.append):
+            passed.append((chunk, list(fired)))
+
+        assert [c for c, _ in passed] == chunks
+        assert passed[2][1] == []
+        assert passed[3][1] == ["SELECT 1"]
+
+    def test_each_block_fires_once(self, core):
+        chunks = ["```sql\nSELECT a\n```", " and ", "```sql\nSELECT b\n```"]
+        fired = []
+        list(core.tee_sql_blocks(chunks, fired.append))
+        assert fired == ["SELECT a", "SELECT b"]
+
+
+# ===================== batch_chat_with_llm =====================
+
+def _batch_output_line(custom_id, content, status_code=200):
+    body = {"choices": [{"message": {"content": content}}]}
+    return json.dumps({"custom_id": custom_id, "response": {"status_code": status_code, "body": body}})
+
+
+class TestBatchChatWithLlm:
+    def test_submits_jsonl_and_returns_results_in_order(self, core):
+        mock_client = Mock()
+        mock_client.batches.create.return_value = SimpleNamespace(status="in_progress", id="b1")
+        mock_client.batches.retrieve.return_value = SimpleNamespace(
+            status="completed", id="b1", output_file_id="out1",
+        )
+        mock_client.files.content.return_value = SimpleNamespace(text="\n".join([
+            _batch_output_line("1", "Second."),
+            _batch_output_line("0", "First."),
+        ]))
+
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            results = core.batch_chat_with_llm(["q0", "q1"], poll_interval=0)
+
+        assert results == ["First.", "Second."]
+        upload = mock_client.files.create.call_args[1]
+        assert upload["purpose"] == "batch"
+        requests = [json.loads(line) for line in upload["file"][1].decode().splitlines()]
+        assert [r["custom_id"] for r in requests] == ["0", "1"]
+        assert requests[0]["url"] == "/v1/chat/completions"
+        assert requests[0]["body"]["messages"][0]["content"] == core.SYSTEM_PROMPT
+        assert requests[1]["body"]["messages"][1]["content"] == "q1"
+        assert mock_client.batches.create.call_args[1]["completion_window"] == "24h"
+
+    def test_failed_request_yields_none(self, core):
+        mock_client = Mock()
+        mock_client.batches.create.return_value = SimpleNamespace(
+            status="completed", id="b1", output_file_id="out1",
+        )
+        mock_client.files.content.return_value = SimpleNamespace(text="\n".join([
+            _batch_output_line("0", "First."),
+            _batch_output_line("1", "", status_code=500),
+        ]))
+
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            results = core.batch_chat_with_llm(["q0", "q1"])
+
+        assert results == ["First.", None]
+
+    def test_failed_batch_raises(self, core):
+        mock_client = Mock()
+        mock_client.batches.create.return_value = SimpleNamespace(status="failed", id="b1")
+
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            with pytest.raises(RuntimeError, match="failed"):
+                core.batch_chat_with_llm(["q0"])
+
+
+# ===================== rows_to_csv =====================
+
+class TestRowsToCsv:
+    def test_header_then_values(self, core):
+        rows = [{"STATE": "TX", "POP": 29145505}, {"STATE": "CA", "POP": 39538223}]
+        assert core.rows_to_csv(rows) == "STATE,POP\nTX,29145505\nCA,39538223"
+
+    def test_quotes_values_with_commas(self, core):
+        assert core.rows_to_csv([{"NAME": "Austin, TX"}]) == 'NAME\n"Austin, TX"'
+
+    def test_null_is_distinct_from_empty_string(self, core):
+        rows = [{"COUNTY": None, "NOTE": ""}]
+        assert core.rows_to_csv(rows) == "COUNTY,NOTE\nNULL,"
+
+    def test_empty_result(self, core):
+        assert core.rows_to_csv([]) == "(no rows)"
+
+
+# ===================== build_results_message =====================
+
+class TestBuildResultsMessage:
+    def test_numbers_each_result(self, core):
+        msg = core.build_results_message(["first", "second"])
+        assert "Query result 1:\nfirst" in msg
+        assert "Query result 2:\nsecond" in msg
+
+    def test_asks_for_summary_without_sql(self, core):
+        msg = core.build_results_message(["x"])
+        assert msg.startswith("Here are the query results:")
+        assert msg.endswith("Do not output any more SQL.")
+
+
+# ===================== compact_history =====================
+
+def _turn(question, answer, results=None):
+    turn = [{"role": "user", "content": question}]
+    if results is not None:
+        turn += [
+            {"role": "assistant", "content": "```sql\nSELECT 1\n```"},
+            results,
+        ]
+    return turn + [{"role": "assistant", "content": answer}]
+
+
+def _omitted(core):
+    return {"role": "user", "content": [{"type": "input_text", "text": core.RESULTS_OMITTED}]}
+
+
+class TestCompactHistory:
+    def test_replaces_results_turns(self, core):
+        messages = _turn("Q", "A", results=core.results_turn(["rows"]))
+        core.compact_history(messages)
+        assert messages[2] == _omitted(core)
+        assert [m["content"] for m in messages[:2]] == ["Q", "```sql\nSELECT 1\n```"]
+
+    def test_keeps_last_questions(self, core):
+        results = core.results_turn(["rows"])
+        messages = _turn("Q1", "A1") + _turn("Q2", "A2", results) + _turn("Q3", "A3")
+        core.compact_history(messages, max_questions=2)
+        assert messages[0] == {"role": "user", "content": "Q2"}
+        assert [m for m in messages if m["role"] == "user"] == [
+            {"role": "user", "content": "Q2"}, _omitted(core), {"role": "user", "content": "Q3"},
+        ]
+
+    def test_question_that_looks_like_results_is_kept(self, core):
+        question = "Here are the query results: what do they mean?"
+        messages = _turn(question, "A1") + _turn("Q2", "A2")
+        core.compact_history(messages, max_questions=2)
+        assert messages[0] == {"role": "user", "content": question}
+
+    def test_short_history_untouched(self, core):
+        messages = _turn("Q1", "A1") + _turn("Q2", "A2")
+        expected = [dict(m) for m in messages]
+        core.compact_history(messages)
+        assert messages == expected
+
+
+# ===================== normalize_sql =====================
+
+class TestNormalizeSql:
+    def test_collapses_whitespace(self, core):
+        assert core.normalize_sql("SELECT  a,\n\tb\nFROM t") == "SELECT a, b FROM t"
+
+    def test_drops_leading_comments_and_semicolons(self, core):
+        assert core.normalize_sql("-- note\n/* x */ SELECT 1 ;;") == "SELECT 1"
+
+    def test_keeps_whitespace_inside_quotes(self, core):
+        sql = 'SELECT "Total:  Renter" FROM t WHERE s = \'a  b\''
+        assert core.normalize_sql(sql) == sql
+
+    def test_drops_inline_comments(self, core):
+        sql = "SELECT a /* why */ FROM t -- note\nWHERE x = '-- kept'"
+        assert core.normalize_sql(sql) == "SELECT a FROM t WHERE x = '-- kept'"
+
+    def test_line_comment_does_not_swallow_the_next_line(self, core):
+        assert core.normalize_sql("SELECT 1 -- note\nFROM t") == "SELECT 1 FROM t"
+        assert core.normalize_sql("SELECT 1 -- note FROM t") == "SELECT 1"
+
+
 # ===================== run_query =====================
 
+def _cursor_conn(rows=()):
+    """Snowflake connection stub whose DictCursor returns rows; yields (conn, cursor)."""
+    cursor = Mock()
+    cursor.fetchmany.return_value = list(rows)
+    conn = Mock()
+    conn.cursor.return_value = cursor
+    return conn, cursor
+
+
+@pytest.fixture
+def empty_cursor_conn():
+    """(conn, cursor) for tests that only check how the cursor was driven."""
+    return _cursor_conn()
+
+
 class TestRunQuery:
     def test_returns_list_of_dicts(self, core):
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("STATE",), ("POP",)]
-        mock_cursor.fetchmany.return_value = [("CA", 39_000_000), ("TX", 29_000_000)]
-        mock_conn = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
+        mock_conn, mock_cursor = _cursor_conn([
+            {"STATE": "CA", "POP": 39_000_000},
+            {"STATE": "TX", "POP": 29_000_000},
+        ])
 
         result = core.run_query("SELECT state, pop FROM t", mock_conn)
+        mock_conn.cursor.assert_called_once_with(core.DictCursor)
         assert result == [
             {"STATE": "CA", "POP": 39_000_000},
             {"STATE": "TX", "POP": 29_000_000},
         ]
 
     def test_returns_error_on_exception(self, core):
-        mock_conn = MagicMock()
+        mock_conn = Mock()
         mock_conn.cursor.side_effect = Exception("Connection lost")
 
         result = core.run_query("SELECT 1", mock_conn)
@@ -341,37 +764,185 @@ class TestRunQuery:
         assert "error" in result
         assert "Connection lost" in result["error"]
 
-    def test_empty_result(self, core):
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("COL",)]
-        mock_cursor.fetchmany.return_value = []
-        mock_conn = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
+    def test_empty_result(self, core, empty_cursor_conn):
+        mock_conn, mock_cursor = empty_cursor_conn
 
         result = core.run_query("SELECT 1 WHERE FALSE", mock_conn)
         assert result == []
 
-    def test_max_rows_passed_to_fetchmany(self, core):
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("X",)]
-        mock_cursor.fetchmany.return_value = []
-        mock_conn = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
+    def test_max_rows_passed_to_fetchmany(self, core, empty_cursor_conn):
+        mock_conn, mock_cursor = empty_cursor_conn
 
         core.run_query("SELECT 1", mock_conn, max_rows=10)
         mock_cursor.fetchmany.assert_called_once_with(10)
 
-    def test_default_max_rows_is_500(self, core):
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("X",)]
-        mock_cursor.fetchmany.return_value = []
-        mock_conn = MagicMock()
-        mock_conn.cursor.return_value = mock_cursor
+    def test_default_max_rows_is_500(self, core, empty_cursor_conn):
+        mock_conn, mock_cursor = empty_cursor_conn
 
         core.run_query("SELECT 1", mock_conn)
         mock_cursor.fetchmany.assert_called_once_with(500)
 
+    def test_cursor_closed_after_fetch(self, core, empty_cursor_conn):
+        mock_conn, mock_cursor = empty_cursor_conn
+
+        core.run_query("SELECT 1", mock_conn)
+        mock_cursor.execute.side_effect = Exception("boom")
+        core.run_query("SELECT 2", mock_conn)
+        assert mock_cursor.close.call_count == 2
+
+    def test_equivalent_sql_is_served_from_cache(self, core):
+        mock_conn, mock_cursor = _cursor_conn([{"STATE": "CA"}])
+
+        first = core.run_query("SELECT state\nFROM t;", mock_conn)
+        second = core.run_query("-- again\nSELECT  state FROM t", mock_conn)
+
+        assert first == second == [{"STATE": "CA"}]
+        mock_cursor.execute.assert_called_once_with("SELECT state\nFROM t;")
+
+    def test_inline_comment_keeps_its_line_break(self, core, empty_cursor_conn):
+        """The normalized text is only a cache key; collapsing newlines would comment out FROM."""
+        mock_conn, mock_cursor = empty_cursor_conn
+        sql = "SELECT state -- name\nFROM t\nWHERE pop > 1"
+
+        core.run_query(sql, mock_conn)
+        mock_cursor.execute.assert_called_once_with(sql)
+
+    def test_comment_that_swallows_a_line_is_a_different_query(self, core):
+        first_conn, _ = _cursor_conn([{"N": 1}])
+        second_conn, second_cursor = _cursor_conn([{"N": 2}])
+
+        core.run_query("SELECT 1 -- note\nFROM t", first_conn)
+        assert core.run_query("SELECT 1 -- note FROM t", second_conn) == [{"N": 2}]
+        second_cursor.execute.assert_called_once()
+
+    def test_cache_is_shared_across_connections(self, core):
+        first_conn, _ = _cursor_conn([{"STATE": "CA"}])
+        second_conn, second_cursor = _cursor_conn([{"STATE": "TX"}])
+
+        core.run_query("SELECT state FROM t", first_conn)
+        assert core.run_query("SELECT state FROM t", second_conn) == [{"STATE": "CA"}]
+        second_cursor.execute.assert_not_called()
+
+    def test_cached_rows_are_fresh_dicts(self, core):
+        mock_conn, mock_cursor = _cursor_conn([{"STATE": "CA"}])
+
+        core.run_query("SELECT state FROM t", mock_conn)[0]["STATE"] = "mutated"
+        assert core.run_query("SELECT state FROM t", mock_conn) == [{"STATE": "CA"}]
+
+    def test_errors_are_not_cached(self, core):
+        mock_conn, mock_cursor = _cursor_conn([{"X": 1}])
+        mock_cursor.execute.side_effect = [Exception("warehouse suspended"), None]
+
+        assert "error" in core.run_query("SELECT 1", mock_conn)
+        assert core.run_query("SELECT 1", mock_conn) == [{"X": 1}]
+
     def test_conn_is_required_param(self, core):
         """run_query requires a conn argument (unlike the old app.run_query)."""
         with pytest.raises(TypeError):
             core.run_query("SELECT 1")
+
+
+# ===================== persistent cache =====================
+
+@pytest.fixture
+def persistent_core(core, monkeypatch, tmp_path):
+    """core reloaded with CACHE_DB_PATH set; reload() re-imports it as a fresh process would."""
+    import importlib
+
+    monkeypatch.setenv("CACHE_DB_PATH", str(tmp_path / "cache.db"))
+
+    def reload():
+        if core._cache_db() is not None:
+            core._cache_db().close()
+        return importlib.reload(core)
+
+    yield reload
+    monkeypatch.setenv("CACHE_DB_PATH", "")
+    reload()
+
+
+class TestPersistentCache:
+    def test_disabled_by_default(self, core):
+        assert core._cache_db() is None
+        assert core._cache_db_execute("SELECT 1") == []
+
+    def test_semantic_cache_survives_restart(self, persistent_core):
+        core = persistent_core()
+        core.semantic_cache_store(core.np.array([1.0, 0.0], dtype=core.np.float32), "Answer.")
+
+        core = persistent_core()
+        mock_client = _embedding_client([[1.0, 0.0]])
+        with patch.object(core, "get_openai_client", return_value=mock_client):
+            result = core.chat_with_llm([{"role": "user", "content": "population of Texas"}])
+
+        assert result == "Answer."
+        mock_client.responses.create.assert_not_called()
+
+    def test_query_results_survive_restart(self, persistent_core):
+        core = persistent_core()
+        mock_conn, mock_cursor = _cursor_conn([{"STATE": "CA"}])
+        core.run_query("SELECT state FROM t", mock_conn)
+
+        core = persistent_core()
+        assert core.run_query("SELECT  state FROM t;", Mock()) == [{"STATE": "CA"}]
+        mock_cursor.execute.assert_called_once()
+
+    def test_errors_are_not_persisted(self, persistent_core):
+        core = persistent_core()
+        mock_conn = Mock()
+        mock_conn.cursor.side_effect = Exception("warehouse suspended")
+        core.run_query("SELECT 1", mock_conn)
+
+        assert core._cache_db_execute("SELECT COUNT(*) FROM query_cache") == [(0,)]
+
+    def test_entries_from_another_prompt_are_not_served(self, persistent_core, monkeypatch):
+        core = persistent_core()
+        core.semantic_cache_store(core.np.array([1.0, 0.0], dtype=core.np.float32), "Old db answer.")
+        mock_conn, _ = _cursor_conn([{"STATE": "CA"}])
+        core.run_query("SELECT state FROM t", mock_conn)
+
+        with monkeypatch.context() as m:
+            m.setenv("SNOWFLAKE_DATABASE", "OTHER_DB")
+            core = persistent_core()
+            assert core._SEM_CACHE == []
+            fresh_conn, fresh_cursor = _cursor_conn([{"STATE": "TX"}])
+            assert core.run_query("SELECT state FROM t", fresh_conn) == [{"STATE": "TX"}]
+            fresh_cursor.execute.assert_called_once()
+
+    def test_rows_are_stored_as_json(self, persistent_core):
+        core = persistent_core()
+        row = {
+            "AVG": decimal.Decimal("27.45"),
+            "DAY": datetime.date(2019, 7, 1),
+            "AT": datetime.datetime(2019, 7, 1, 8, 30),
+            "NAME": "Travis",
+            "POP": None,
+        }
+        mock_conn, _ = _cursor_conn([row])
+        core.run_query("SELECT avg, day, at, name, pop FROM t", mock_conn)
+
+        (stored,), = core._cache_db_execute("SELECT rows FROM query_cache")
+        assert json.loads(stored) == [{
+            "AVG": {"$decimal": "27.45"},
+            "DAY": {"$date": "2019-07-01"},
+            "AT": {"$datetime": "2019-07-01 08:30:00"},
+            "NAME": "Travis",
+            "POP": None,
+        }]
+        core = persistent_core()
+        assert core.run_query("SELECT avg, day, at, name, pop FROM t", Mock()) == [row]
+
+    def test_unversioned_tables_are_dropped(self, persistent_core, tmp_path):
+        import sqlite3
+
+        legacy = sqlite3.connect(tmp_path / "cache.db")
+        legacy.execute("CREATE TABLE prompt_cache (prompt_hash TEXT PRIMARY KEY, "
+                       "response TEXT, embedding BLOB, used REAL)")
+        legacy.execute("CREATE TABLE query_cache (sql TEXT, max_rows INTEGER, rows BLOB, "
+                       "PRIMARY KEY (sql, max_rows))")
+        legacy.execute("INSERT INTO query_cache VALUES ('SELECT 1', 500, x'80')")
+        legacy.commit()
+        legacy.close()
+
+        core = persistent_core()
+        assert core._cache_db_execute("SELECT COUNT(*) FROM query_cache") == [(0,)]
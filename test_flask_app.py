@@ -1,68 +1,103 @@
 """Comprehensive tests for flask_app.py — all routes, chat pipeline, edge cases."""
 
+import datetime
+import decimal
 import json
-import os
+import queue
+import threading
+from contextlib import contextmanager, nullcontext
+from types import SimpleNamespace
+
+import orjson
 import pytest
-from unittest.mock import patch, MagicMock
-
-# Set env vars BEFORE any imports
-os.environ.update({
-    "SNOWFLAKE_ACCOUNT": "test_account",
-    "SNOWFLAKE_USER": "test_user",
-    "SNOWFLAKE_PASSWORD": "test_password",
-    "SNOWFLAKE_DATABASE": "TEST_DB",
-    "SNOWFLAKE_SCHEMA": "TEST_SCHEMA",
-    "SNOWFLAKE_WAREHOUSE": "TEST_WH",
-    "OPENAI_API_KEY": "sk-test-key",
-})
+from unittest.mock import MagicMock, Mock
 
+import core
 import flask_app as fa
 
 
-@pytest.fixture
-def client():
-    """Flask test client with fresh conversation state."""
+@pytest.fixture(scope="module")
+def _client_session():
+    """One Flask test client for the whole module."""
     fa.app.config["TESTING"] = True
-    fa._conversations.clear()
     with fa.app.test_client() as c:
         yield c
 
 
 @pytest.fixture
-def mock_snowflake():
+def client(_client_session):
+    """The shared test client with fresh conversation state and no session cookie."""
+    fa._conversations.clear()
+    _client_session.delete_cookie(fa.app.config["SESSION_COOKIE_NAME"])
+    return _client_session
+
+
+def _json(resp):
+    """Parse a response body with orjson, matching the app's own JSON provider."""
+    return orjson.loads(resp.data)
+
+
+def _ensure_sid(client):
+    """Put a session id in the client's cookie without rendering the landing page."""
+    with client.session_transaction() as sess:
+        return sess.setdefault("sid", "test-sid")
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    """Stand-in for the LLM call; tests set return_value or side_effect."""
+    mock_llm = Mock(return_value="Answer.")
+    monkeypatch.setattr(fa, "chat_with_llm", mock_llm)
+    return mock_llm
+
+
+@pytest.fixture
+def mock_snowflake(monkeypatch):
     """Mock get_snowflake_connection to avoid real Snowflake calls."""
     mock_conn = MagicMock()
-    with patch.object(fa, "get_snowflake_connection", return_value=mock_conn):
-        yield mock_conn
+    monkeypatch.setattr(fa, "get_snowflake_connection", lambda: nullcontext(mock_conn))
+    return mock_conn
+
+
+def _cursor(rows, execute=lambda sql: None):
+    """A bare DictCursor stand-in; far cheaper than a MagicMock in the chat loop."""
+    return SimpleNamespace(execute=execute, fetchmany=lambda size=None: rows, close=lambda: None)
 
 
 # ===================== GET / =====================
 
-class TestIndex:
-    def test_returns_200(self, client):
-        resp = client.get("/")
-        assert resp.status_code == 200
+@pytest.fixture(scope="module")
+def index_html():
+    """The landing page, rendered once per module by calling the view directly."""
+    with fa.app.test_request_context("/"):
+        return fa.app.view_functions["index"]()
 
-    def test_returns_html(self, client):
-        resp = client.get("/")
-        assert b"Census Chat" in resp.data
 
-    def test_contains_suggestion_buttons(self, client):
-        resp = client.get("/")
-        html = resp.data.decode()
-        assert "longest average commute" in html
-        assert "30% of income on rent" in html
-        assert "moved from another state" in html
-        assert "language other than English" in html
+@pytest.fixture(scope="module")
+def index_lower(index_html):
+    """The landing page lower-cased once for case-insensitive checks."""
+    return index_html.lower()
 
-    def test_contains_chat_form(self, client):
-        resp = client.get("/")
-        assert b"chat-form" in resp.data
-        assert b"user-input" in resp.data
 
-    def test_contains_reset_button(self, client):
+class TestIndex:
+    def test_returns_200(self, client):
         resp = client.get("/")
-        assert b"reset-btn" in resp.data
+        assert resp.status_code == 200
+
+    @pytest.mark.parametrize("fragment", [
+        "Census Chat",
+        # suggestion buttons
+        "longest average commute",
+        "30% of income on rent",
+        "moved from another state",
+        "language other than English",
+        # chat form
+        "chat-form",
+        "user-input",
+        "reset-btn",
+    ])
+    def test_contains(self, index_html, fragment):
+        assert fragment in index_html
 
     def test_sets_session_id(self, client):
         with client.session_transaction() as sess:
@@ -75,24 +110,16 @@ class TestIndex:
 # ===================== POST /chat — validation =====================
 
 class TestChatValidation:
-    def test_empty_message_returns_400(self, client, mock_snowflake):
-        resp = client.post("/chat", json={"message": ""})
-        assert resp.status_code == 400
-        data = resp.get_json()
-        assert "error" in data
-        assert "Empty" in data["error"]
-
-    def test_whitespace_only_returns_400(self, client, mock_snowflake):
-        resp = client.post("/chat", json={"message": "   "})
-        assert resp.status_code == 400
-
-    def test_missing_message_key_returns_400(self, client, mock_snowflake):
-        resp = client.post("/chat", json={})
-        assert resp.status_code == 400
-
-    def test_null_message_returns_400(self, client, mock_snowflake):
-        resp = client.post("/chat", json={"message": None})
+    @pytest.mark.parametrize("body", [
+        {"message": ""},
+        {"message": "   "},
+        {},
+        {"message": None},
+    ], ids=["empty", "whitespace", "missing", "null"])
+    def test_rejects_bad_payload(self, client, mock_snowflake, body):
+        resp = client.post("/chat", json=body)
         assert resp.status_code == 400
+        assert "Empty" in _json(resp)["error"]
 
 
 # ===================== POST /chat — off-topic guardrail =====================
@@ -101,42 +128,36 @@ class TestChatGuardrail:
     def test_off_topic_returns_refusal(self, client, mock_snowflake):
         resp = client.post("/chat", json={"message": "tell me about porn"})
         assert resp.status_code == 200
-        data = resp.get_json()
+        data = _json(resp)
         assert len(data["steps"]) == 1
         assert data["steps"][0]["type"] == "answer"
         assert "Census" in data["steps"][0]["content"]
 
-    def test_off_topic_does_not_call_llm(self, client, mock_snowflake):
-        with patch("flask_app.chat_with_llm") as mock_llm:
-            client.post("/chat", json={"message": "how to build a bomb"})
-            mock_llm.assert_not_called()
+    def test_off_topic_does_not_call_llm(self, client, mock_snowflake, llm):
+        client.post("/chat", json={"message": "how to build a bomb"})
+        llm.assert_not_called()
 
     @pytest.mark.parametrize("word", ["drugs", "hack", "weapon", "suicide", "kill"])
-    def test_various_off_topic_words(self, client, mock_snowflake, word):
-        resp = client.post("/chat", json={"message": f"tell me about {word}"})
-        data = resp.get_json()
-        assert data["steps"][0]["type"] == "answer"
-        assert "Census" in data["steps"][0]["content"]
+    def test_various_off_topic_words(self, word):
+        # The route wiring is covered above; check the guardrail the route uses directly
+        assert fa.is_off_topic(f"tell me about {word}")
 
 
 # ===================== POST /chat — text answer (no SQL) =====================
 
 class TestChatTextAnswer:
-    def test_simple_text_response(self, client, mock_snowflake):
-        with patch("flask_app.chat_with_llm", return_value="The population of CA is about 39 million."):
-            resp = client.post("/chat", json={"message": "What is the population of California?"})
-        data = resp.get_json()
+    def test_simple_text_response(self, client, mock_snowflake, llm):
+        llm.return_value = "The population of CA is about 39 million."
+        resp = client.post("/chat", json={"message": "What is the population of California?"})
+        data = _json(resp)
         assert len(data["steps"]) == 1
         assert data["steps"][0]["type"] == "answer"
         assert "39 million" in data["steps"][0]["content"]
 
-    def test_stores_messages_in_conversation(self, client, mock_snowflake):
-        with patch("flask_app.chat_with_llm", return_value="Answer."):
-            client.get("/")  # init session
-            client.post("/chat", json={"message": "Hello"})
+    def test_stores_messages_in_conversation(self, client, mock_snowflake, llm):
+        sid = _ensure_sid(client)
+        client.post("/chat", json={"message": "Hello"})
 
-        with client.session_transaction() as sess:
-            sid = sess["sid"]
         messages = fa._conversations[sid]
         assert len(messages) == 2  # user + assistant
         assert messages[0]["role"] == "user"
@@ -148,29 +169,19 @@ class TestChatTextAnswer:
 # ===================== POST /chat — SQL pipeline =====================
 
 class TestChatSqlPipeline:
-    def test_sql_then_summary(self, client, mock_snowflake):
+    def test_sql_then_summary(self, client, mock_snowflake, llm):
         """LLM returns SQL first, then a text summary on second call."""
-        llm_responses = [
+        llm.side_effect = [
             "Let me query:\n```sql\nSELECT state FROM t\n```",
             "The answer is California.",
         ]
-        call_count = {"n": 0}
-
-        def fake_llm(messages):
-            idx = call_count["n"]
-            call_count["n"] += 1
-            return llm_responses[idx]
 
         # Mock run_query to return data
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("STATE",)]
-        mock_cursor.fetchmany.return_value = [("CA",)]
-        mock_snowflake.cursor.return_value = mock_cursor
+        mock_snowflake.cursor.return_value = _cursor([{"STATE": "CA"}])
 
-        with patch("flask_app.chat_with_llm", side_effect=fake_llm):
-            resp = client.post("/chat", json={"message": "Which state has most people?"})
+        resp = client.post("/chat", json={"message": "Which state has most people?"})
 
-        data = resp.get_json()
+        data = _json(resp)
         step_types = [s["type"] for s in data["steps"]]
         assert "llm_response" in step_types
         assert "query_result" in step_types
@@ -180,144 +191,199 @@ class TestChatSqlPipeline:
         qr = [s for s in data["steps"] if s["type"] == "query_result"][0]
         assert qr["content"] == [{"STATE": "CA"}]
 
-    def test_unsafe_sql_blocked(self, client, mock_snowflake):
+    def test_unsafe_sql_blocked(self, client, mock_snowflake, llm):
         """If LLM produces DROP, it should be blocked."""
-        llm_responses = [
+        llm.side_effect = [
             "```sql\nDROP TABLE users\n```",
             "Sorry, I can't do that.",
         ]
-        call_count = {"n": 0}
-
-        def fake_llm(messages):
-            idx = call_count["n"]
-            call_count["n"] += 1
-            return llm_responses[idx]
 
-        with patch("flask_app.chat_with_llm", side_effect=fake_llm):
-            resp = client.post("/chat", json={"message": "Drop the users table"})
+        resp = client.post("/chat", json={"message": "Drop the users table"})
 
-        data = resp.get_json()
+        data = _json(resp)
         step_types = [s["type"] for s in data["steps"]]
         assert "query_error" in step_types
         blocked_step = [s for s in data["steps"] if s["type"] == "query_error"][0]
         assert "blocked" in blocked_step["content"].lower() or "safety" in blocked_step["content"].lower()
 
-    def test_query_execution_error(self, client, mock_snowflake):
+    def test_query_execution_error(self, client, mock_snowflake, llm):
         """If Snowflake returns an error, it should appear as query_error step."""
         mock_snowflake.cursor.side_effect = Exception("Syntax error in SQL")
 
-        llm_responses = [
+        llm.side_effect = [
             "```sql\nSELECT bad_col FROM t\n```",
             "There was an error.",
         ]
-        call_count = {"n": 0}
-
-        def fake_llm(messages):
-            idx = call_count["n"]
-            call_count["n"] += 1
-            return llm_responses[idx]
 
-        with patch("flask_app.chat_with_llm", side_effect=fake_llm):
-            resp = client.post("/chat", json={"message": "Query something"})
+        resp = client.post("/chat", json={"message": "Query something"})
 
-        data = resp.get_json()
+        data = _json(resp)
         step_types = [s["type"] for s in data["steps"]]
         assert "query_error" in step_types
 
-    def test_llm_exception_returns_error_step(self, client, mock_snowflake):
+    def test_connection_failure_is_fed_back(self, client, llm, monkeypatch):
+        """A failed checkout/connect becomes a query_error the model can answer, not a 500."""
+        @contextmanager
+        def failing_connection():
+            raise Exception("bad creds")
+            yield
+
+        monkeypatch.setattr(fa, "get_snowflake_connection", failing_connection)
+        llm.side_effect = ["```sql\nSELECT 1\n```", "Snowflake is unavailable right now."]
+
+        resp = client.post("/chat", json={"message": "Population of Texas?"})
+
+        assert resp.status_code == 200
+        steps = _json(resp)["steps"]
+        assert [s["type"] for s in steps] == ["llm_response", "query_error", "answer"]
+        assert "bad creds" in steps[1]["content"]
+        transcript = fa._conversations[_ensure_sid(client)]
+        assert core.is_results_turn(transcript[-2])
+        assert "bad creds" in transcript[-2]["content"][0]["text"]
+        assert transcript[-1] == {"role": "assistant", "content": "Snowflake is unavailable right now."}
+
+    def test_llm_exception_returns_error_step(self, client, mock_snowflake, llm):
         """If LLM call raises an exception, we get an error step."""
-        with patch("flask_app.chat_with_llm", side_effect=RuntimeError("API timeout")):
-            resp = client.post("/chat", json={"message": "hello"})
+        llm.side_effect = RuntimeError("API timeout")
+        resp = client.post("/chat", json={"message": "hello"})
 
-        data = resp.get_json()
+        data = _json(resp)
         assert len(data["steps"]) == 1
         assert data["steps"][0]["type"] == "error"
         assert "API timeout" in data["steps"][0]["content"]
 
-    def test_multiple_sql_blocks(self, client, mock_snowflake):
+    def test_multiple_sql_blocks(self, client, mock_snowflake, llm):
         """LLM returns multiple SQL blocks — both should be executed."""
         llm_sql = "Query 1:\n```sql\nSELECT a FROM t1\n```\nQuery 2:\n```sql\nSELECT b FROM t2\n```"
 
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("A",)]
-        mock_cursor.fetchmany.return_value = [("x",)]
-        mock_snowflake.cursor.return_value = mock_cursor
-
-        call_count = {"n": 0}
+        mock_snowflake.cursor.return_value = _cursor([{"A": "x"}])
 
-        def fake_llm(messages):
-            idx = call_count["n"]
-            call_count["n"] += 1
-            if idx == 0:
-                return llm_sql
-            return "Summary of both queries."
+        llm.side_effect = [llm_sql, "Summary of both queries."]
+        resp = client.post("/chat", json={"message": "Run two queries"})
 
-        with patch("flask_app.chat_with_llm", side_effect=fake_llm):
-            resp = client.post("/chat", json={"message": "Run two queries"})
-
-        data = resp.get_json()
+        data = _json(resp)
         qr_steps = [s for s in data["steps"] if s["type"] == "query_result"]
         assert len(qr_steps) == 2
 
-    def test_max_rounds_exhausted(self, client, mock_snowflake):
-        """If LLM keeps producing SQL for 5 rounds, we get an error."""
-        mock_cursor = MagicMock()
-        mock_cursor.description = [("X",)]
-        mock_cursor.fetchmany.return_value = [(1,)]
-        mock_snowflake.cursor.return_value = mock_cursor
+    def test_multiple_sql_blocks_run_concurrently(self, client, mock_snowflake, llm):
+        """Both queries must be in flight at once to get past the barrier."""
+        barrier = threading.Barrier(2, timeout=5)
+        mock_snowflake.cursor.return_value = _cursor([{"A": "x"}], execute=lambda sql: barrier.wait())
+
+        llm.side_effect = [
+            "```sql\nSELECT a FROM t1\n```\n```sql\nDROP TABLE t\n```\n```sql\nSELECT b FROM t2\n```",
+            "Summary.",
+        ]
+        resp = client.post("/chat", json={"message": "Run three queries"})
 
-        def always_sql(messages):
-            return "```sql\nSELECT 1\n```"
+        step_types = [s["type"] for s in _json(resp)["steps"]]
+        assert step_types == ["llm_response", "query_result", "query_error", "query_result", "answer"]
 
-        with patch("flask_app.chat_with_llm", side_effect=always_sql):
-            resp = client.post("/chat", json={"message": "Keep querying"})
+    def test_connection_opens_while_llm_runs(self, client, monkeypatch, llm):
+        """Checking out the connection must not hold up the first LLM call."""
+        llm_started = threading.Event()
+        overlapped = []
 
-        data = resp.get_json()
+        @contextmanager
+        def slow_checkout():
+            overlapped.append(llm_started.wait(timeout=5))
+            yield MagicMock()
+
+        def fake_llm(messages):
+            llm_started.set()
+            return "Answer."
+
+        monkeypatch.setattr(fa, "get_snowflake_connection", slow_checkout)
+        llm.side_effect = fake_llm
+        resp = client.post("/chat", json={"message": "Hello"})
+
+        assert _json(resp)["steps"][0]["content"] == "Answer."
+        assert overlapped == [True]
+
+    def test_max_rounds_exhausted(self, client, mock_snowflake, llm, monkeypatch):
+        """If LLM keeps producing SQL for every round, we get an error."""
+        monkeypatch.setattr(fa, "MAX_CHAT_ROUNDS", 2)
+        mock_snowflake.cursor.return_value = _cursor([{"X": 1}])
+
+        llm.return_value = "```sql\nSELECT 1\n```"
+        resp = client.post("/chat", json={"message": "Keep querying"})
+
+        data = _json(resp)
         last_step = data["steps"][-1]
         assert last_step["type"] == "error"
         assert "trouble" in last_step["content"].lower() or "rephras" in last_step["content"].lower()
+        assert llm.call_count == 2
+
+
+    def test_decimal_results_serialized_as_strings(self, client, mock_snowflake, llm):
+        """Scaled NUMBER columns arrive as Decimal and must survive JSON encoding."""
+        mock_snowflake.cursor.return_value = _cursor([{"AVG_COMMUTE": decimal.Decimal("27.45")}])
+
+        llm.side_effect = ["```sql\nSELECT avg_commute FROM t\n```", "About 27 minutes."]
+        resp = client.post("/chat", json={"message": "Average commute?"})
+
+        assert resp.mimetype == "application/json"
+        qr = [s for s in _json(resp)["steps"] if s["type"] == "query_result"][0]
+        assert qr["content"] == [{"AVG_COMMUTE": "27.45"}]
 
 
 # ===================== POST /chat — multi-turn conversation =====================
 
 class TestChatMultiTurn:
-    def test_conversation_persists_across_requests(self, client, mock_snowflake):
+    def test_conversation_persists_across_requests(self, client, mock_snowflake, llm):
         """Second message should have context from the first."""
-        call_count = {"n": 0}
+        fa._conversations[_ensure_sid(client)] = [
+            {"role": "user", "content": "Population of California?"},
+            {"role": "assistant", "content": "California has 39 million people."},
+        ]
+        llm.return_value = "Yes, and Texas has 29 million."
+        resp = client.post("/chat", json={"message": "What about Texas?"})
 
-        def fake_llm(messages):
-            call_count["n"] += 1
-            if call_count["n"] == 1:
-                return "California has 39 million people."
-            # Second call should have prior context
-            assert any("California" in m["content"] for m in messages)
-            return "Yes, and Texas has 29 million."
-
-        with patch("flask_app.chat_with_llm", side_effect=fake_llm):
-            client.get("/")
-            client.post("/chat", json={"message": "Population of California?"})
-            resp = client.post("/chat", json={"message": "What about Texas?"})
-
-        data = resp.get_json()
+        data = _json(resp)
         assert "Texas" in data["steps"][0]["content"]
+        # The call should carry the prior turn as context
+        messages = llm.call_args.args[0]
+        assert any("California" in m["content"] for m in messages)
+
+
+    def test_rounds_extend_and_finished_turns_are_compacted(self, client, mock_snowflake, llm):
+        """Rounds within a request extend each other verbatim; finished turns only lose raw results."""
+        mock_snowflake.cursor.return_value = _cursor([{"STATE": "CA"}])
+
+        llm_responses = iter([
+            "```sql\nSELECT state FROM t\n```",
+            "California.",
+            "Texas.",
+        ])
+        seen = []
+
+        def fake_llm(messages):
+            seen.append([dict(m) for m in messages])
+            return next(llm_responses)
+
+        llm.side_effect = fake_llm
+        client.post("/chat", json={"message": "Most populous state?"})
+        client.post("/chat", json={"message": "And the second?"})
+
+        assert seen[1][:len(seen[0])] == seen[0]
+        omitted = [{"type": "input_text", "text": core.RESULTS_OMITTED}]
+        compacted = seen[1][:-1] + [{"role": "user", "content": omitted}]
+        assert seen[2][:len(compacted)] == compacted
 
 
 # ===================== POST /reset =====================
 
 class TestReset:
-    def test_reset_clears_conversation(self, client, mock_snowflake):
-        with patch("flask_app.chat_with_llm", return_value="Answer."):
-            client.get("/")
-            client.post("/chat", json={"message": "Hello"})
+    def test_reset_clears_conversation(self, client, mock_snowflake, llm):
+        sid = _ensure_sid(client)
+        client.post("/chat", json={"message": "Hello"})
 
-        with client.session_transaction() as sess:
-            sid = sess["sid"]
         assert sid in fa._conversations
         assert len(fa._conversations[sid]) > 0
 
         resp = client.post("/reset")
         assert resp.status_code == 200
-        data = resp.get_json()
+        data = _json(resp)
         assert data["ok"] is True
         assert sid not in fa._conversations
 
@@ -325,126 +391,146 @@ class TestReset:
         """Reset on fresh session should not error."""
         resp = client.post("/reset")
         assert resp.status_code == 200
-        assert resp.get_json()["ok"] is True
+        assert _json(resp)["ok"] is True
 
-    def test_reset_then_new_conversation(self, client, mock_snowflake):
+    def test_reset_then_new_conversation(self, client, mock_snowflake, llm):
         """After reset, the next chat should start fresh."""
-        call_count = {"n": 0}
+        _ensure_sid(client)
+        client.post("/chat", json={"message": "First question"})
+        client.post("/reset")
+        client.post("/chat", json={"message": "New question"})
+
+        # After reset, the conversation should only contain the new message
+        user_msgs = [m for m in llm.call_args_list[1].args[0] if m["role"] == "user"]
+        assert [m["content"] for m in user_msgs] == ["New question"]
 
-        def fake_llm(messages):
-            call_count["n"] += 1
-            # After reset, messages list should only contain the new message
-            if call_count["n"] == 2:
-                user_msgs = [m for m in messages if m["role"] == "user"]
-                assert len(user_msgs) == 1
-                assert user_msgs[0]["content"] == "New question"
-            return "Response."
 
-        with patch("flask_app.chat_with_llm", side_effect=fake_llm):
-            client.get("/")
-            client.post("/chat", json={"message": "First question"})
-            client.post("/reset")
-            client.post("/chat", json={"message": "New question"})
+# ===================== Snowflake connection pool =====================
 
+def _pool(*conns):
+    """A pool whose slots hold the given connections (None = not yet connected)."""
+    pool = queue.LifoQueue(maxsize=len(conns))
+    for conn in conns:
+        pool.put(conn)
+    return pool
 
-# ===================== Snowflake connection singleton =====================
 
 class TestSnowflakeConnection:
-    def test_lazy_creation(self):
-        fa._sf_conn = None
-        mock_conn = MagicMock()
-        mock_conn.is_closed.return_value = False
-        with patch("flask_app.snowflake.connector.connect", return_value=mock_conn) as mock_connect:
-            conn = fa.get_snowflake_connection()
-            assert conn is mock_conn
-            mock_connect.assert_called_once()
-
-    def test_reuses_open_connection(self):
-        mock_conn = MagicMock()
-        mock_conn.is_closed.return_value = False
-        fa._sf_conn = mock_conn
-        with patch("flask_app.snowflake.connector.connect") as mock_connect:
-            conn = fa.get_snowflake_connection()
-            assert conn is mock_conn
-            mock_connect.assert_not_called()
-
-    def test_reconnects_when_closed(self):
-        old_conn = MagicMock()
-        old_conn.is_closed.return_value = True
-        fa._sf_conn = old_conn
+    @pytest.mark.parametrize("pooled_closed, expect_connect", [
+        (None, True),
+        (False, False),
+        (True, True),
+    ], ids=["lazy", "reuses_open", "reconnects_closed"])
+    def test_checkout(self, monkeypatch, pooled_closed, expect_connect):
+        pooled = None
+        if pooled_closed is not None:
+            pooled = MagicMock()
+            pooled.is_closed.return_value = pooled_closed
+        monkeypatch.setattr(fa, "_sf_pool", _pool(pooled))
 
         new_conn = MagicMock()
-        with patch("flask_app.snowflake.connector.connect", return_value=new_conn) as mock_connect:
-            conn = fa.get_snowflake_connection()
-            assert conn is new_conn
-            mock_connect.assert_called_once()
-
-    def test_reconnects_when_none(self):
-        fa._sf_conn = None
+        mock_connect = Mock(return_value=new_conn)
+        monkeypatch.setattr(fa.snowflake.connector, "connect", mock_connect)
+        with fa.get_snowflake_connection() as conn:
+            assert conn is (new_conn if expect_connect else pooled)
+        assert mock_connect.call_count == int(expect_connect)
+
+    def test_connection_returned_to_pool(self, monkeypatch):
+        monkeypatch.setattr(fa, "_sf_pool", _pool(None))
         new_conn = MagicMock()
-        with patch("flask_app.snowflake.connector.connect", return_value=new_conn):
-            conn = fa.get_snowflake_connection()
-            assert conn is new_conn
+        monkeypatch.setattr(fa.snowflake.connector, "connect", Mock(return_value=new_conn))
+        with fa.get_snowflake_connection():
+            assert fa._sf_pool.empty()
+        assert fa._sf_pool.get_nowait() is new_conn
+
+    def test_slot_kept_when_connect_fails(self, monkeypatch):
+        monkeypatch.setattr(fa, "_sf_pool", _pool(None))
+        monkeypatch.setattr(fa.snowflake.connector, "connect", Mock(side_effect=Exception("bad creds")))
+        with pytest.raises(Exception, match="bad creds"):
+            with fa.get_snowflake_connection():
+                pass
+        assert fa._sf_pool.qsize() == 1
+
+    def test_concurrent_requests_get_distinct_connections(self, monkeypatch):
+        monkeypatch.setattr(fa, "_sf_pool", _pool(None, None))
+        monkeypatch.setattr(fa.snowflake.connector, "connect", Mock(side_effect=lambda **kw: MagicMock()))
+        with fa.get_snowflake_connection() as first, fa.get_snowflake_connection() as second:
+            assert first is not second
+
+
+# ===================== JSON provider =====================
+
+class TestJsonProvider:
+    @pytest.mark.parametrize("args, kwargs, expected", [
+        ((), {}, None),
+        (([1, 2],), {}, [1, 2]),
+        ((1, 2), {}, [1, 2]),
+        ((), {"ok": True}, {"ok": True}),
+    ], ids=["nothing", "one_value", "several_values", "keywords"])
+    def test_response_follows_jsonify(self, args, kwargs, expected):
+        with fa.app.app_context():
+            resp = fa.app.json.response(*args, **kwargs)
+        assert resp.mimetype == "application/json"
+        assert _json(resp) == expected
+
+    @pytest.mark.parametrize("value, expected", [
+        (decimal.Decimal("27.45"), "27.45"),
+        (datetime.date(2019, 7, 1), "Mon, 01 Jul 2019 00:00:00 GMT"),
+        (2**70, 2**70),
+    ], ids=["decimal", "date", "beyond_64_bits"])
+    def test_matches_flask_default_provider(self, value, expected):
+        with fa.app.app_context():
+            resp = fa.app.json.response({"V": value})
+        assert json.loads(resp.data) == {"V": expected}
+        assert fa.app.json.loads(fa.app.json.dumps({"V": value})) == {"V": expected}
+
+    def test_response_rejects_args_and_kwargs(self):
+        with pytest.raises(TypeError):
+            fa.app.json.response(1, ok=True)
 
 
 # ===================== HTML template structure =====================
 
 class TestHtmlTemplate:
-    def test_bootstrap_css_included(self, client):
-        resp = client.get("/")
-        assert b"bootstrap@5" in resp.data
+    @pytest.mark.parametrize("fragment", ["bootstrap@5", "marked", "spinner", "chat-area"])
+    def test_contains(self, index_html, fragment):
+        assert fragment in index_html
 
-    def test_marked_js_included(self, client):
-        resp = client.get("/")
-        assert b"marked" in resp.data
-
-    def test_all_four_suggestion_questions(self, client):
-        resp = client.get("/")
-        html = resp.data.decode()
-        assert "commute" in html.lower()
-        assert "rent" in html.lower()
-        assert "moved" in html.lower()
-        assert "language" in html.lower()
+    @pytest.mark.parametrize("topic", ["commute", "rent", "moved", "language"])
+    def test_suggestion_question_topics(self, index_lower, topic):
+        assert topic in index_lower
 
-    def test_spinner_present(self, client):
-        resp = client.get("/")
-        assert b"spinner" in resp.data
 
-    def test_chat_area_present(self, client):
-        resp = client.get("/")
-        assert b"chat-area" in resp.data
+# ===================== Edge cases =====================
 
+_LONG_MSG = "What is the population? " * 1000
 
-# ===================== Edge cases =====================
 
 class TestEdgeCases:
-    def test_json_content_type_not_required(self, client, mock_snowflake):
+    def test_json_content_type_not_required(self, client, mock_snowflake, llm):
         """POST /chat with force=True should accept non-JSON content-type."""
         resp = client.post(
             "/chat",
             data=json.dumps({"message": "test"}),
             content_type="text/plain",
         )
-        # Should not 400 on content-type; force=True in flask_app handles this
-        # It may still 200 or fail from LLM mock — but not 415
-        assert resp.status_code != 415
+        # Should not 400/415 on content-type; force=True in flask_app handles this
+        assert resp.status_code == 200
 
-    def test_very_long_message(self, client, mock_snowflake):
+    @pytest.mark.slow
+    def test_very_long_message(self, client, mock_snowflake, llm):
         """Very long message should not crash."""
-        long_msg = "What is the population? " * 1000
-        with patch("flask_app.chat_with_llm", return_value="Answer."):
-            resp = client.post("/chat", json={"message": long_msg})
+        resp = client.post("/chat", json={"message": _LONG_MSG})
         assert resp.status_code == 200
 
-    def test_special_characters_in_message(self, client, mock_snowflake):
+    def test_special_characters_in_message(self, client, mock_snowflake, llm):
         """Messages with special chars should not crash."""
-        with patch("flask_app.chat_with_llm", return_value="Answer."):
-            resp = client.post("/chat", json={"message": "What about <script>alert('xss')</script>?"})
+        resp = client.post("/chat", json={"message": "What about <script>alert('xss')</script>?"})
         assert resp.status_code == 200
-        data = resp.get_json()
+        data = _json(resp)
         assert data["steps"][0]["type"] == "answer"
 
-    def test_unicode_message(self, client, mock_snowflake):
-        with patch("flask_app.chat_with_llm", return_value="Respuesta."):
-            resp = client.post("/chat", json={"message": "Poblacion de California?"})
+    def test_unicode_message(self, client, mock_snowflake, llm):
+        llm.return_value = "Respuesta."
+        resp = client.post("/chat", json={"message": "Poblacion de California?"})
         assert resp.status_code == 200